@@ -1,9 +1,14 @@
-from typing import TYPE_CHECKING, Optional, Union
+import asyncio
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional, Union
 
 import discord as di
-from slidge import MucType
+from slidge import LegacyParticipant, MucType
 from slixmpp.exceptions import XMPPError
 
+from . import config
+from .tracing import span
+
 if TYPE_CHECKING:
     from .contact import Contact
     from .group import Participant
@@ -38,12 +43,225 @@ async def captcha_handler(
     )
 
 
+Sender = Union["Contact", "Participant"]
+
+
+class Resolved(NamedTuple):
+    """
+    How the author of a message was resolved to a sender.
+    """
+
+    # legacy ID of the MUC, None for direct messages
+    muc_id: Optional[int]
+    # legacy ID of the contact (or of the user), None for contact-less
+    # participants
+    user_id: Optional[int]
+    # nickname of contact-less participants
+    nickname: Optional[str] = None
+
+
+class SenderCache:
+    """
+    (channel ID, author ID) → how the sender of the incoming messages was
+    resolved, so that the steady-state relay does not go through discord
+    channel lookups and slidge's contact and MUC creation paths.
+
+    Only IDs are cached: senders are rebuilt from slidge's store on every
+    use, so that they reflect the current state of their MUC, eg, the XMPP
+    resources the user joined it from.
+
+    Entries are invalidated explicitly on member, user and channel changes.
+    Users that could not be resolved to contacts (eg, deleted users) are
+    remembered too.
+
+    Webhooks post under arbitrary names with the same ID, so they are cached
+    separately, per channel, by webhook ID and name.
+    """
+
+    MAX_SIZE = 10_000
+    MAX_WEBHOOKS_PER_CHANNEL = 100
+    MAX_UNKNOWN_USERS = 1_000
+
+    def __init__(self):
+        self.__senders = OrderedDict[tuple[int, int], Resolved]()
+        self.__by_user = dict[int, set[int]]()
+        self.__by_channel = dict[int, set[int]]()
+        self.__webhooks = dict[int, OrderedDict[tuple[int, str], Resolved]]()
+        self.__unknown_users = OrderedDict[int, None]()
+
+    def __len__(self):
+        return (
+            len(self.__senders)
+            + sum(len(w) for w in self.__webhooks.values())
+            + len(self.__unknown_users)
+        )
+
+    def get(self, channel_id: int, user_id: int) -> Optional[Resolved]:
+        resolved = self.__senders.get((channel_id, user_id))
+        if resolved is not None:
+            self.__senders.move_to_end((channel_id, user_id))
+        return resolved
+
+    def set(self, channel_id: int, user_id: int, resolved: Resolved):
+        self.__senders[(channel_id, user_id)] = resolved
+        self.__by_user.setdefault(user_id, set()).add(channel_id)
+        self.__by_channel.setdefault(channel_id, set()).add(user_id)
+        while len(self.__senders) > self.MAX_SIZE:
+            (c, u), _ = self.__senders.popitem(last=False)
+            self.__unlink(c, u)
+
+    def __unlink(self, channel_id: int, user_id: int):
+        if users := self.__by_channel.get(channel_id):
+            users.discard(user_id)
+            if not users:
+                del self.__by_channel[channel_id]
+        if channels := self.__by_user.get(user_id):
+            channels.discard(channel_id)
+            if not channels:
+                del self.__by_user[user_id]
+
+    def is_unknown(self, user_id: int) -> bool:
+        if user_id not in self.__unknown_users:
+            return False
+        self.__unknown_users.move_to_end(user_id)
+        return True
+
+    def add_unknown(self, user_id: int):
+        self.__unknown_users[user_id] = None
+        while len(self.__unknown_users) > self.MAX_UNKNOWN_USERS:
+            self.__unknown_users.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        self.__unknown_users.pop(user_id, None)
+        for channel_id in list(self.__by_user.get(user_id, ())):
+            del self.__senders[(channel_id, user_id)]
+            self.__unlink(channel_id, user_id)
+
+    def get_webhook(
+        self, channel_id: int, webhook_id: int, name: str
+    ) -> Optional[Resolved]:
+        webhooks = self.__webhooks.get(channel_id)
+        if not webhooks or (resolved := webhooks.get((webhook_id, name))) is None:
+            return None
+        webhooks.move_to_end((webhook_id, name))
+        return resolved
+
+    def set_webhook(
+        self, channel_id: int, webhook_id: int, name: str, resolved: Resolved
+    ):
+        webhooks = self.__webhooks.setdefault(channel_id, OrderedDict())
+        webhooks[(webhook_id, name)] = resolved
+        while len(webhooks) > self.MAX_WEBHOOKS_PER_CHANNEL:
+            webhooks.popitem(last=False)
+
+    def invalidate_webhooks(self, channel_id: int):
+        self.__webhooks.pop(channel_id, None)
+
+    def invalidate_channel(self, channel_id: int):
+        self.invalidate_webhooks(channel_id)
+        for user_id in list(self.__by_channel.get(channel_id, ())):
+            del self.__senders[(channel_id, user_id)]
+            self.__unlink(channel_id, user_id)
+
+
+class _Typer:
+    __slots__ = "expiry", "channel", "author"
+
+    def __init__(
+        self, expiry: asyncio.TimerHandle, channel: MessageableChannel, author: Author
+    ):
+        self.expiry = expiry
+        self.channel = channel
+        self.author = author
+
+
+class TypingState:
+    """
+    Users currently typing, per channel.
+
+    Discord repeats TYPING_START events while a user types; only the first one
+    is relayed, and a "paused" chat state is sent when none was received for
+    the duration of discord's typing indicator. In group channels, the number
+    of concurrent typers that are relayed is capped by ``MUC_MAX_TYPERS``.
+
+    Typers are kept as discord channels and users, and resolved to senders
+    again when they expire.
+    """
+
+    # how long discord shows a typing indicator after a TYPING_START
+    WINDOW = 10
+
+    def __init__(self, on_expire: Callable[[MessageableChannel, Author], None]):
+        self.__typers = dict[int, dict[int, _Typer]]()
+        self.__on_expire = on_expire
+
+    def __len__(self):
+        return sum(len(typers) for typers in self.__typers.values())
+
+    def start(
+        self, channel: MessageableChannel, author: Author, is_group: bool
+    ) -> bool:
+        """
+        Register a typing event.
+
+        :return: Whether a "composing" chat state should be sent for it
+        """
+        typers = self.__typers.setdefault(channel.id, {})
+        typer = typers.get(author.id)
+        loop = asyncio.get_running_loop()
+        if typer is not None:
+            typer.expiry.cancel()
+            typer.expiry = loop.call_later(
+                self.WINDOW, self.__expire, channel.id, author.id
+            )
+            return False
+        if is_group and 0 < config.MUC_MAX_TYPERS <= len(typers):
+            return False
+        typers[author.id] = _Typer(
+            loop.call_later(self.WINDOW, self.__expire, channel.id, author.id),
+            channel,
+            author,
+        )
+        return True
+
+    def stop(self, channel_id: int, user_id: int):
+        """
+        Forget a typer without sending a "paused" chat state, eg, because they
+        sent a message.
+        """
+        typers = self.__typers.get(channel_id)
+        if not typers or (typer := typers.pop(user_id, None)) is None:
+            return
+        typer.expiry.cancel()
+        if not typers:
+            del self.__typers[channel_id]
+
+    def clear(self):
+        """
+        Forget all typers and cancel their pending "paused" chat states, eg,
+        on logout.
+        """
+        for typers in self.__typers.values():
+            for typer in typers.values():
+                typer.expiry.cancel()
+        self.__typers.clear()
+
+    def __expire(self, channel_id: int, user_id: int):
+        typers = self.__typers[channel_id]
+        typer = typers.pop(user_id)
+        if not typers:
+            del self.__typers[channel_id]
+        self.__on_expire(typer.channel, typer.author)
+
+
 class Discord(di.Client):
     def __init__(self, session: "Session"):
         self.session = session
         super().__init__(captcha_handler=captcha_handler)
         self.log = session.log
         self.ignore_next_msg_event = set[int]()
+        self.senders = SenderCache()
+        self.typing = TypingState(self.__on_typing_expire)
 
     def __ignore(self, mid: int):
         if mid in self.ignore_next_msg_event:
@@ -52,19 +270,38 @@ class Discord(di.Client):
         return False
 
     async def on_message(self, message: di.Message):
-        async with self.session.send_lock:
-            if self.__ignore(message.id):
-                return
-
-        if sender := await self.get_sender_by_message(message):
-            await sender.send_message(message)
+        with self.session.tracer.trace("discord message", id=message.id):
+            with span("send lock"):
+                async with self.session.send_lock:
+                    if self.__ignore(message.id):
+                        return
+
+            self.typing.stop(message.channel.id, message.author.id)
+            with span("get sender"):
+                sender = await self.get_sender_by_message(message)
+            if sender:
+                await sender.send_message(message)
 
     async def on_typing(self, channel: MessageableChannel, user: Author, _when):
         if user == self.user:
             return
 
-        if contact := await self.get_sender(author=user, channel=channel):
+        is_group = not isinstance(channel, di.DMChannel)
+        if not self.typing.start(channel, user, is_group):
+            return
+
+        contact = await self.get_sender(author=user, channel=channel)
+        if contact:
             contact.composing()
+        else:
+            self.typing.stop(channel.id, user.id)
+
+    def __on_typing_expire(self, channel: MessageableChannel, user: Author):
+        self.session.create_task(self.__paused(channel, user))
+
+    async def __paused(self, channel: MessageableChannel, user: Author):
+        if contact := await self.get_sender(author=user, channel=channel):
+            contact.paused()
 
     async def on_message_edit(self, before: di.Message, after: di.Message):
         if before.content == after.content:
@@ -90,35 +327,53 @@ class Discord(di.Client):
             muc = await self.session.bookmarks.by_legacy_id(m.channel.id)
             muc.get_system_participant().moderate(m.id)
 
+    async def on_raw_message_edit(self, payload: di.RawMessageUpdateEvent):
+        self.session.quotes.discard(payload.message_id)
+
+    async def on_raw_message_delete(self, payload: di.RawMessageDeleteEvent):
+        self.session.quotes.discard(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: di.RawBulkMessageDeleteEvent):
+        for mid in payload.message_ids:
+            self.session.quotes.discard(mid)
+        message_ids = [mid for mid in payload.message_ids if not self.__ignore(mid)]
+        if not message_ids:
+            return
+
+        channel = self.get_channel(payload.channel_id)
+        if not isinstance(channel, (di.TextChannel, di.GroupChannel)):
+            self.log.debug("Ignoring bulk delete in %s", channel)
+            return
+
+        try:
+            muc = await self.session.bookmarks.by_legacy_id(channel.id)
+        except XMPPError as e:
+            self.log.debug("Ignoring bulk delete in %s because of %s", channel, e)
+            return
+
+        await muc.moderate_many(message_ids)
+
     async def on_reaction_add(self, reaction: di.Reaction, user: Author):
-        await self.update_reactions(reaction, user)
+        await self.update_reactions(reaction, user, added=True)
 
     async def on_reaction_remove(self, reaction: di.Reaction, user: Author):
-        await self.update_reactions(reaction, user)
+        await self.update_reactions(reaction, user, added=False)
 
-    async def update_reactions(self, reaction: di.Reaction, user: Author):
+    async def update_reactions(self, reaction: di.Reaction, user: Author, added: bool):
         message = reaction.message
         channel = message.channel
 
-        if isinstance(message.channel, di.DMChannel):
-            if isinstance(user, di.ClientUser):
-                await self.session.update_reactions(message)
-            else:
-                contact = await self.get_contact(user)
-                await contact.update_reactions(message)
+        if isinstance(user, di.ClientUser) or user.id == self.user.id:  # type:ignore
+            if isinstance(channel, (di.DMChannel, di.TextChannel, di.GroupChannel)):
+                await self.session.update_reactions(message, reaction.emoji, added)
+
+        elif isinstance(channel, di.DMChannel):
+            contact = await self.get_contact(user)
+            await contact.update_reactions(message)
 
         elif isinstance(channel, (di.TextChannel, di.GroupChannel)):
             muc = await self.session.bookmarks.by_legacy_id(channel.id)
-
-            if user.id == self.user.id:  # type:ignore
-                self.log.debug("ME: %s %s", user, type(user))
-                participant = await muc.get_user_participant()
-            else:
-                self.log.debug("NOT ME: %s %s", user, type(user))
-                participant = await muc.get_participant_by_contact(
-                    await self.session.contacts.by_legacy_id(user.id)
-                )
-
+            participant = await muc.get_participant_by_discord_user(user)
             await participant.update_reactions(message)
 
     async def on_presence_update(
@@ -149,17 +404,104 @@ class Discord(di.Client):
                 p.update_status(friend.status, friend.activity)
 
     async def on_guild_presence_update(self, member: di.Member):
+        # members of large guilds are added to MUCs lazily, so only the
+        # participants that exist already are updated; the store indexes them
+        # by contact, so this does not go through every channel of the guild
+        contact = self.session.contacts.by_legacy_id_if_exists(member.id)
+        if contact is None:
+            return
         guild = member.guild
-        # contact = await self.session.contacts.by_discord_user(member.user)
+        for participant in contact.participants:
+            if guild.get_channel(participant.muc.legacy_id) is not None:
+                participant.update_status(member.status, member.activity)
+
+    async def on_guild_channel_create(self, channel: di.abc.GuildChannel):
+        self.session.channels.update(channel)
+
+    async def on_guild_channel_update(
+        self, before: di.abc.GuildChannel, after: di.abc.GuildChannel
+    ):
+        self.session.channels.update(after)
+        self.senders.invalidate_channel(after.id)
+        if not isinstance(after, di.TextChannel):
+            return
+        if muc := self.session.bookmarks.by_legacy_id_if_exists(after.id):
+            muc.on_channel_update(before, after)  # type:ignore
+
+    async def on_private_channel_update(
+        self, before: di.abc.PrivateChannel, after: di.abc.PrivateChannel
+    ):
+        if not isinstance(after, di.GroupChannel):
+            return
+        self.senders.invalidate_channel(after.id)
+        if muc := self.session.bookmarks.by_legacy_id_if_exists(after.id):
+            muc.on_channel_update(before, after)  # type:ignore
+
+    async def on_guild_channel_delete(self, channel: di.abc.GuildChannel):
+        self.session.channels.remove(channel)
+        self.session.threads.forget_channel(channel)
+        self.senders.invalidate_channel(channel.id)
+
+    async def on_guild_update(self, before: di.Guild, after: di.Guild):
+        self.session.channels.invalidate(after)
+        for channel in after.text_channels:
+            if muc := self.session.bookmarks.by_legacy_id_if_exists(channel.id):
+                muc.on_guild_update(before, after)
+
+    async def on_guild_remove(self, guild: di.Guild):
+        self.session.channels.invalidate(guild)
+        self.session.members.forget_guild(guild.id)
+        self.session.threads.forget_guild(guild.id)
         for channel in guild.channels:
-            if not isinstance(channel, di.TextChannel):
-                continue
-            try:
-                muc = await self.session.bookmarks.by_legacy_id(channel.id)
-            except XMPPError:
-                continue
-            participant = await muc.get_participant_by_legacy_id(member.id)
-            participant.update_status(member.status, member.activity)
+            self.senders.invalidate_channel(channel.id)
+
+    async def on_guild_role_create(self, role: di.Role):
+        self.session.channels.invalidate(role.guild)
+
+    async def on_guild_role_update(self, _before: di.Role, after: di.Role):
+        self.session.channels.invalidate(after.guild)
+
+    async def on_guild_role_delete(self, role: di.Role):
+        self.session.channels.invalidate(role.guild)
+
+    async def on_member_update(self, before: di.Member, after: di.Member):
+        if after.id == self.user.id and before.roles != after.roles:  # type:ignore
+            self.session.channels.invalidate(after.guild)
+        self.senders.invalidate_user(after.id)
+        self.session.members.add(after)
+
+    async def on_thread_create(self, thread: di.Thread):
+        self.session.threads.add(thread)
+
+    async def on_thread_join(self, thread: di.Thread):
+        self.session.threads.add(thread)
+
+    async def on_thread_update(self, _before: di.Thread, after: di.Thread):
+        self.session.threads.add(after)
+
+    async def on_raw_thread_delete(self, payload: di.RawThreadDeleteEvent):
+        self.session.threads.remove(payload.guild_id, payload.thread_id)
+
+    async def on_webhooks_update(self, channel: di.abc.GuildChannel):
+        self.senders.invalidate_webhooks(channel.id)
+
+    async def on_member_join(self, member: di.Member):
+        self.senders.invalidate_user(member.id)
+        self.session.members.add(member)
+
+    async def on_member_remove(self, member: di.Member):
+        self.senders.invalidate_user(member.id)
+        self.session.members.remove(member.guild.id, member.id)
+
+    async def on_user_update(self, _before: di.User, after: di.User):
+        self.senders.invalidate_user(after.id)
+        self.session.members.update_user(after)
+
+    async def on_relationship_add(self, relationship: di.Relationship):
+        self.senders.invalidate_user(relationship.user.id)
+
+    async def on_relationship_remove(self, relationship: di.Relationship):
+        self.senders.invalidate_user(relationship.user.id)
 
     async def get_contact(self, user: Union[di.User, di.Member]):
         return await self.session.contacts.by_discord_user(user)
@@ -171,15 +513,72 @@ class Discord(di.Client):
         self,
         author: Author,
         channel: MessageableChannel,
-    ) -> Optional[Union["Contact", "Participant"]]:
+    ) -> Optional[Sender]:
         if isinstance(channel, di.Thread):
-            parent = channel.parent
-            if isinstance(parent, di.TextChannel):
-                channel = parent
-            else:
-                self.log.debug("Ignoring thread of %s", parent)
+            parent_id = self.session.threads.parent_id(channel)
+            if parent_id is None:
+                self.log.debug("Ignoring thread of %s", channel.parent)
                 return None
-
+            parent = self.get_channel(parent_id)
+            if not isinstance(parent, di.TextChannel):
+                self.log.debug("Ignoring thread of unknown channel %s", parent_id)
+                return None
+            channel = parent
+
+        # webhooks reuse the same ID with arbitrary names
+        webhook = author.discriminator == "0000"
+        if webhook:
+            resolved = self.senders.get_webhook(
+                channel.id, author.id, author.display_name
+            )
+        else:
+            resolved = self.senders.get(channel.id, author.id)
+        if resolved is not None:
+            sender = await self.__rebuild(resolved, webhook)
+            if sender is not None:
+                return sender
+            # the MUC is gone
+            self.senders.invalidate_channel(channel.id)
+
+        sender = await self.__get_sender(author, channel)
+        if sender is None or (resolved := self.__resolve(author, sender)) is None:
+            return sender
+        if webhook:
+            self.senders.set_webhook(
+                channel.id, author.id, author.display_name, resolved
+            )
+        else:
+            self.senders.set(channel.id, author.id, resolved)
+        return sender
+
+    @staticmethod
+    def __resolve(author: Author, sender: Sender) -> Optional[Resolved]:
+        if not isinstance(sender, LegacyParticipant):
+            return Resolved(None, sender.legacy_id)
+        if sender.is_system:
+            return None
+        if sender.is_user or sender.contact is not None:
+            return Resolved(sender.muc.legacy_id, author.id)
+        return Resolved(sender.muc.legacy_id, None, sender.nickname)
+
+    async def __rebuild(self, resolved: Resolved, webhook: bool) -> Optional[Sender]:
+        if resolved.muc_id is None:
+            assert resolved.user_id is not None
+            return await self.session.contacts.by_legacy_id(resolved.user_id)
+        muc = self.session.bookmarks.by_legacy_id_if_exists(resolved.muc_id)
+        if muc is None:
+            return None
+        if webhook:
+            assert resolved.nickname is not None
+            return await muc.get_webhook(resolved.nickname)
+        if resolved.user_id is None:
+            assert resolved.nickname is not None
+            return await muc.get_participant(resolved.nickname)
+        return await muc.get_participant_by_legacy_id(resolved.user_id)
+
+    async def __get_sender(
+        self, author: Author, channel: MessageableChannel
+    ) -> Optional[Sender]:
         if isinstance(channel, di.DMChannel):
             if isinstance(author, di.ClientUser):
                 return await self.get_contact(channel.recipient)
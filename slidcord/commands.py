@@ -1,11 +1,12 @@
 import discord as di
 from slidge import FormField
 from slidge.command import Command, CommandAccess, Form, TableResult
-from slidge.command.categories import GROUPS
+from slidge.command.categories import ADMINISTRATION, GROUPS
 from slixmpp import JID
 from slixmpp.exceptions import XMPPError
 
 from .session import Session
+from .util import rss
 
 
 class ListGuilds(Command):
@@ -15,6 +16,8 @@ class ListGuilds(Command):
     ACCESS = CommandAccess.USER_LOGGED
     CATEGORY = GROUPS
 
+    PAGE_SIZE = 50
+
     async def run(self, session, ifrom: JID, *args):
         assert isinstance(session, Session)
         guilds = session.discord.guilds
@@ -30,7 +33,13 @@ class ListGuilds(Command):
                     options=[
                         {"label": g.name, "value": str(i)} for i, g in enumerate(guilds)
                     ],
-                )
+                ),
+                FormField(
+                    "filter",
+                    "Only show channels whose name contains",
+                    required=False,
+                ),
+                FormField("page", "Page", required=False, value="1"),
             ],
             handler=self.list_guilds,  # type:ignore
             handler_args=(guilds,),
@@ -43,23 +52,94 @@ class ListGuilds(Command):
         try:
             guild_id = int(form_values["guild_id"])
             guild = guilds[int(guild_id)]
+            page = int(form_values.get("page") or 1)
         except (ValueError, IndexError, KeyError):
             raise XMPPError("bad-request")
-        channels = []
-        for c in guild.channels:
-            if not isinstance(c, di.TextChannel):
-                continue
-            try:
-                channels.append(await session.bookmarks.by_legacy_id(c.id))
-            except XMPPError:
-                continue
-        channels.sort(key=lambda ch: ch.name)
+        search = (form_values.get("filter") or "").lower()
+        channels = [
+            c
+            for c in session.channels.channels(guild)
+            if c.readable and search in c.name.lower()
+        ]
+        n_pages = max(1, -(-len(channels) // ListGuilds.PAGE_SIZE))
+        if not 1 <= page <= n_pages:
+            raise XMPPError("bad-request", f"There are only {n_pages} pages")
+        start = (page - 1) * ListGuilds.PAGE_SIZE
         return TableResult(
             fields=[
                 FormField("name", "Name"),
                 FormField("jid", "JID", type="jid-single"),
             ],
-            description=f"Text channels of server {guild}",
-            items=[{"name": c.name, "jid": c.jid} for c in channels],
+            description=(
+                f"Text channels of server {guild} (page {page}/{n_pages}, "
+                f"{len(channels)} channels)"
+            ),
+            items=[
+                {"name": c.name, "jid": c.jid}
+                for c in channels[start : start + ListGuilds.PAGE_SIZE]
+            ],
             jids_are_mucs=True,
         )
+
+
+class Trace(Command):
+    NAME = "Trace message relaying"
+    HELP = (
+        "Record how long each stage of relaying messages takes for a user, "
+        "in a trace file on the gateway host"
+    )
+    CHAT_COMMAND = NODE = "trace"
+    ACCESS = CommandAccess.ADMIN_ONLY
+    CATEGORY = ADMINISTRATION
+
+    async def run(self, _session, _ifrom: JID, *args):
+        return Form(
+            title="Trace message relaying",
+            instructions="Switch tracing on or off for a user",
+            fields=[
+                FormField("jid", "User", required=True, type="jid-single"),
+                FormField("enabled", "Enabled", type="boolean", value="true"),
+            ],
+            handler=self.trace,  # type:ignore
+        )
+
+    async def trace(self, form_values: dict, _session, _ifrom):
+        session = self.xmpp.get_session_from_jid(JID(form_values["jid"]))
+        if not isinstance(session, Session):
+            raise XMPPError("item-not-found", "This user has no active session")
+        if form_values.get("enabled"):
+            session.tracer.start()
+            return f"Tracing to {session.tracer.path}"
+        session.tracer.stop()
+        return "Tracing stopped"
+
+
+class MemoryUsage(Command):
+    NAME = "Memory usage"
+    HELP = "Show what a user's session keeps in memory"
+    CHAT_COMMAND = NODE = "memory"
+    ACCESS = CommandAccess.ADMIN_ONLY
+    CATEGORY = ADMINISTRATION
+
+    async def run(self, _session, _ifrom: JID, *args):
+        return Form(
+            title="Memory usage",
+            instructions="Select a user",
+            fields=[FormField("jid", "User", required=True, type="jid-single")],
+            handler=self.memory_usage,  # type:ignore
+        )
+
+    async def memory_usage(self, form_values: dict, _session, _ifrom):
+        session = self.xmpp.get_session_from_jid(JID(form_values["jid"]))
+        if not isinstance(session, Session):
+            raise XMPPError("item-not-found", "This user has no active session")
+        description = f"Objects held by the session of {session.user_jid.bare}"
+        if (size := rss()) is not None:
+            description += f" (gateway process: {size / 1024 / 1024:.0f} MiB)"
+        return TableResult(
+            fields=[FormField("name", "Cache"), FormField("count", "Objects")],
+            description=description,
+            items=[
+                {"name": k, "count": str(v)} for k, v in session.memory_usage().items()
+            ],
+        )
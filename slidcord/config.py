@@ -12,6 +12,95 @@ MUC_BACK_FILL__DOC = (
 AUTO_FETCH_FRIENDS_BIO = False
 AUTO_FETCH_FRIENDS_BIO__DOC = (
     "If set to true, slidcord will automatically fetch the 'bio' of your discord "
-    "friends on startup, to push VCards4 to you. Disabled by default because of "
-    "the rate limiting it triggers for some users."
+    "friends in the background after startup, to push VCards4 to you. "
+    "Fetches are paced according to PROFILE_FETCH_RATE and cached for "
+    "BIO_CACHE_TTL hours."
+)
+
+PROFILE_FETCH_RATE = 6.0
+PROFILE_FETCH_RATE__DOC = (
+    "Maximum number of discord profiles fetched per minute, per user. "
+    "Profiles requested by XMPP clients are fetched before the ones fetched "
+    "automatically (see AUTO_FETCH_FRIENDS_BIO). Set to 0 for no limit."
+)
+
+PROFILE_FETCH_BURST = 3
+PROFILE_FETCH_BURST__DOC = (
+    "Number of discord profiles that can be fetched in a row before "
+    "PROFILE_FETCH_RATE applies."
+)
+
+BIO_CACHE_TTL = 24
+BIO_CACHE_TTL__DOC = (
+    "Number of hours during which a fetched bio is considered fresh, "
+    "across slidcord restarts."
+)
+
+MODERATION_BATCH_SIZE = 20
+MODERATION_BATCH_SIZE__DOC = (
+    "When messages are deleted in bulk (eg, by a moderation bot), slidcord "
+    "sends the corresponding moderation stanzas in batches of this size."
+)
+
+MODERATION_BATCH_INTERVAL = 0.5
+MODERATION_BATCH_INTERVAL__DOC = (
+    "Number of seconds to wait between two batches of moderation stanzas, "
+    "so that the XMPP server is not flooded on bulk deletions."
+)
+
+ATTACHMENT_CACHE_SIZE = 500
+ATTACHMENT_CACHE_SIZE__DOC = (
+    "Maximum size, in MiB, of the on-disk cache of discord attachments. "
+    "Attachments that slidge already uploaded are reused by slidge. The cache is "
+    "used when such an upload is gone, since discord's attachment URLs expire. "
+    "Set to 0 to disable the cache."
+)
+
+AVATAR_FETCH_CONCURRENCY = 4
+AVATAR_FETCH_CONCURRENCY__DOC = (
+    "Maximum number of avatars downloaded at the same time for a session. "
+    "Avatars of friends are fetched first, then other users', then servers'."
+)
+
+ROSTER_FILL_CONCURRENCY = 20
+ROSTER_FILL_CONCURRENCY__DOC = (
+    "Number of friends that are added to the roster concurrently on startup. "
+    "Their presences are then sent in batches of the same size."
+)
+
+FILE_BATCH_WINDOW = 1.0
+FILE_BATCH_WINDOW__DOC = (
+    "Files sent from XMPP to the same channel within this number of seconds "
+    "are grouped in a single discord message (up to 10 files and 10 MiB), "
+    "unless something else is sent in between. Such messages cannot be "
+    "corrected or retracted from XMPP. "
+    "Set to 0 to send every file in its own message."
+)
+
+MUC_LAZY_PARTICIPANTS = 1000
+MUC_LAZY_PARTICIPANTS__DOC = (
+    "In discord servers with more members than this, joining a text channel "
+    "only adds its owner, moderators, recent speakers, and online members (up to "
+    "this number) as participants. The other members are added when they speak "
+    "or react. Set to 0 to always add every member."
+)
+
+WARM_RESTART = True
+WARM_RESTART__DOC = (
+    "Keep a snapshot of each session (own discord identity, last presences of "
+    "friends) so that after a restart, the roster is published right away "
+    "instead of after discord sent its full initial state."
+)
+
+TRACE_SAMPLE_RATE = 0.1
+TRACE_SAMPLE_RATE__DOC = (
+    "Fraction of the messages that are traced, for sessions where tracing was "
+    "enabled with the 'trace' admin command. Traces are written in the chrome "
+    "trace event format, in the slidcord_traces folder of the home directory."
+)
+
+MUC_MAX_TYPERS = 5
+MUC_MAX_TYPERS__DOC = (
+    "Maximum number of users shown as typing at the same time in a discord "
+    "text channel or group. Set to 0 for no limit."
 )
@@ -1,11 +1,16 @@
-from typing import TYPE_CHECKING, Union
+import asyncio
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional, Union
 
 import discord as di
 from slidge import LegacyContact, LegacyRoster
 from slixmpp.exceptions import XMPPError
 
 from . import config
-from .util import MessageMixin, StatusMixin
+from .media import AvatarFetcher
+from .snapshot import Snapshot
+from .snapshot import status as snapshot_status
+from .util import MessageMixin, StatusMixin, TokenBucket
 
 if TYPE_CHECKING:
     from .group import Participant
@@ -22,7 +27,6 @@ class Contact(StatusMixin, MessageMixin, LegacyContact[int]):  # type: ignore
 
     @property
     def discord_user(self) -> di.User:  # type: ignore
-        self.session.log.debug("Searching for user: %s", self.legacy_id)
         user = self.session.discord.get_user(self.legacy_id)
         # self.session.discord.get_guild().get_member()
         if user is None:
@@ -32,46 +36,286 @@ class Contact(StatusMixin, MessageMixin, LegacyContact[int]):  # type: ignore
         return user
 
     @property
-    def direct_channel_id(self):
-        assert self.discord_user.dm_channel is not None
-        return self.discord_user.dm_channel.id
+    def direct_channel_id(self) -> Optional[int]:
+        return self.session.dms.cached(self.legacy_id)
 
     async def update_info(self):
         u = self.discord_user
         if u.bot or u.system:
             self.DISCO_CATEGORY = "bot"
         self.name = u.display_name
-        if a := u.avatar:
-            await self.set_avatar(a.url, a.key)
-
         self.is_friend = u.is_friend()
+        if a := u.avatar:
+            self.session.avatars.fetch(
+                self,
+                a,
+                AvatarFetcher.FRIEND if self.is_friend else AvatarFetcher.CONTACT,
+            )
 
         # massive rate limiting if trying to fetch profiles of non friends
         if config.AUTO_FETCH_FRIENDS_BIO and self.is_friend:
-            await self.fetch_vcard()
+            self.session.profiles.fetch_later(self)
 
         # TODO: use the relationship here
         # relationship = u.relationship
 
     async def fetch_vcard(self):
+        bio = await self.session.profiles.fetch(self.legacy_id)
+        if bio is not None:
+            self.set_vcard(full_name=self.name, note=bio)
+
+
+class CachedBio(NamedTuple):
+    bio: str
+    fetched_at: float
+
+    @property
+    def expired(self):
+        return time.time() - self.fetched_at > config.BIO_CACHE_TTL * 3600
+
+
+class ProfileFetcher:
+    """
+    Fetches discord profiles ("bios") within a strict rate budget, and caches
+    them in the user's legacy module data so that they survive restarts.
+
+    Profiles requested on demand, eg, when an XMPP client requests a vCard,
+    are fetched before the ones queued in the background on startup. Fetched
+    bios are persisted in batches, at most every ``SAVE_INTERVAL`` seconds,
+    and expired ones are dropped when loading and saving them.
+    """
+
+    SAVE_INTERVAL = 60
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.__bucket = TokenBucket(
+            config.PROFILE_FETCH_RATE / 60, max(config.PROFILE_FETCH_BURST, 1)
+        )
+        self.__bios: Optional[dict[str, CachedBio]] = None
+        self.__fetches = dict[int, asyncio.Task[Optional[str]]]()
+        self.__queue = dict[int, None]()  # ordered set
+        self.__n_on_demand = 0
+        self.__worker: Optional[asyncio.Task] = None
+        self.__saver: Optional[asyncio.Task] = None
+        self.__dirty = False
+
+    def __len__(self):
+        return len(self.__cache)
+
+    @property
+    def __cache(self) -> dict[str, CachedBio]:
+        if self.__bios is None:
+            self.__bios = self.__load()
+        return self.__bios
+
+    def __load(self) -> dict[str, CachedBio]:
+        bios = dict[str, CachedBio]()
+        stored = self.session.user.legacy_module_data.get("bios")
+        if not isinstance(stored, dict):
+            return bios
+        for user_id, entry in stored.items():
+            if not isinstance(entry, list) or len(entry) != 2:
+                continue
+            bio, fetched_at = entry
+            if not isinstance(bio, str) or not isinstance(fetched_at, (int, float)):
+                continue
+            cached = CachedBio(bio, fetched_at)
+            if not cached.expired:
+                bios[user_id] = cached
+        return bios
+
+    def save(self):
+        """
+        Persist the bios fetched since the last save, if any.
+        """
+        if not self.__dirty:
+            return
+        self.__dirty = False
+        if self.__saver is not None:
+            self.__saver.cancel()
+            self.__saver = None
+        self.__bios = {k: v for k, v in self.__cache.items() if not v.expired}
+        self.session.legacy_module_data_update({"bios": self.__bios})
+
+    async def __save_later(self):
+        await asyncio.sleep(self.SAVE_INTERVAL)
+        self.__saver = None
+        self.save()
+
+    def cached(self, user_id: int) -> Optional[CachedBio]:
+        return self.__cache.get(str(user_id))
+
+    async def fetch(self, user_id: int, on_demand=True) -> Optional[str]:
+        """
+        Get the bio of a discord user, from the cache if it has not expired.
+
+        :param user_id: The discord ID of the user
+        :param on_demand: Whether this request jumps ahead of the background ones
+        :return: The bio (empty if the user has none), or None if it could not be
+            fetched
+        """
+        if (cached := self.cached(user_id)) and not cached.expired:
+            return cached.bio
+
+        task = self.__fetches.get(user_id)
+        if task is None:
+            task = self.__fetches[user_id] = asyncio.create_task(self.__fetch(user_id))
+            task.add_done_callback(lambda _: self.__fetches.pop(user_id, None))
+
+        if on_demand:
+            self.__n_on_demand += 1
         try:
-            profile = await self.discord_user.profile()
+            return await asyncio.shield(task)
+        finally:
+            if on_demand:
+                self.__n_on_demand -= 1
+
+    async def __fetch(self, user_id: int) -> Optional[str]:
+        user = self.session.discord.get_user(user_id)
+        if user is None:
+            return None
+
+        await self.__bucket.acquire()
+        try:
+            profile = await user.profile()
         except di.Forbidden:
-            self.session.log.debug("Forbidden to fetch the profile of %s", self)
+            self.session.log.debug("Forbidden to fetch the profile of %s", user)
+            return None
         except di.HTTPException as e:
             self.session.log.debug(
-                "HTTP exception %s when fetch the profile of %s", e, self
+                "HTTP exception %s when fetch the profile of %s", e, user
             )
-        else:
-            self.set_vcard(full_name=self.name, note=profile.bio)
+            return None
+
+        bio = profile.bio or ""
+        self.__cache[str(user_id)] = CachedBio(bio, time.time())
+        self.__dirty = True
+        if self.__saver is None:
+            self.__saver = self.session.create_task(self.__save_later())
+        return bio
+
+    def fetch_later(self, contact: Contact):
+        """
+        Set the vCard of a contact from the cache, and queue a background fetch
+        of their profile if it is not cached or has expired.
+        """
+        cached = self.cached(contact.legacy_id)
+        if cached is not None:
+            contact.set_vcard(full_name=contact.name, note=cached.bio)
+            if not cached.expired:
+                return
+        self.__queue[contact.legacy_id] = None
+        if self.__worker is None or self.__worker.done():
+            self.__worker = self.session.create_task(self.__work())
+
+    async def __work(self):
+        while self.__queue:
+            while self.__n_on_demand:
+                await asyncio.sleep(1)
+            user_id = next(iter(self.__queue))
+            del self.__queue[user_id]
+            bio = await self.fetch(user_id, on_demand=False)
+            if bio is None:
+                continue
+            try:
+                contact = await self.session.contacts.by_legacy_id(user_id)
+            except XMPPError:
+                continue
+            contact.set_vcard(full_name=contact.name, note=bio)
+
+
+class DMChannels:
+    """
+    Maps discord users to the IDs of their DM channels with the session's
+    user, in the user's legacy module data so that it survives restarts.
+
+    Known DM channels are returned as partial messageables, which do not
+    require the channel to be in the library cache. Unknown ones are created
+    on demand, with a single REST call per user.
+    """
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.__ids: Optional[dict[str, int]] = None
+        self.__creations = dict[int, asyncio.Task[int]]()
+
+    def __len__(self):
+        return len(self.__cache)
+
+    @property
+    def __cache(self) -> dict[str, int]:
+        if self.__ids is None:
+            stored = self.session.user.legacy_module_data.get("dm_channels") or {}
+            assert isinstance(stored, dict)
+            self.__ids = dict(stored)  # type:ignore
+        return self.__ids
+
+    def cached(self, user_id: int) -> Optional[int]:
+        return self.__cache.get(str(user_id))
+
+    def add(self, user_id: int, channel_id: int):
+        if self.cached(user_id) == channel_id:
+            return
+        self.__cache[str(user_id)] = channel_id
+        self.session.legacy_module_data_update({"dm_channels": self.__cache})
+
+    async def get(self, user_id: int) -> Union[di.DMChannel, di.PartialMessageable]:
+        discord = self.session.discord
+        user = discord.get_user(user_id)
+        if user is not None and (dm := user.dm_channel) is not None:
+            self.add(user_id, dm.id)
+            return dm
+
+        channel_id = self.cached(user_id)
+        if channel_id is None:
+            task = self.__creations.get(user_id)
+            if task is None:
+                task = self.__creations[user_id] = asyncio.create_task(
+                    self.__create(user_id)
+                )
+                task.add_done_callback(lambda _: self.__creations.pop(user_id, None))
+            channel_id = await asyncio.shield(task)
+        return discord.get_partial_messageable(channel_id, type=di.ChannelType.private)
+
+    async def __create(self, user_id: int) -> int:
+        try:
+            dm = await self.session.discord.create_dm(di.Object(user_id))
+        except di.HTTPException as e:
+            raise XMPPError(
+                "recipient-unavailable", f"Could not create the DM channel: {e}"
+            )
+        self.session.log.debug("Created %s", dm)
+        self.add(user_id, dm.id)
+        return dm.id
 
 
 class Roster(LegacyRoster[int, Contact]):
     session: "Session"
 
+    def __init__(self, session: "Session"):
+        super().__init__(session)
+        # fill() runs at login, and again once a warm restart is reconciled
+        # with discord
+        self.__fill_lock = asyncio.Lock()
+
     async def by_discord_user(self, u: Union[di.User, di.Member]) -> Contact:
         return await self.by_legacy_id(u.id)
 
+    def by_legacy_id_if_exists(self, legacy_id: int) -> Optional[Contact]:
+        """
+        Get a contact only if it was resolved before, without calling
+        update_info.
+        """
+        store = self.session.xmpp.store
+        with store.session():
+            stored = store.contacts.get_by_legacy_id(
+                self.session.user_pk, str(legacy_id)
+            )
+            if stored is not None and stored.updated:
+                return Contact.from_store(self.session, stored)
+        return None
+
     async def jid_username_to_legacy_id(self, username: str):
         try:
             user_id = int(username)
@@ -91,16 +335,77 @@ class Roster(LegacyRoster[int, Contact]):
                 )
             return user_id
 
+    def __fill_from_snapshot(self, snapshot: "Snapshot"):
+        n = 0
+        for c in self:
+            if (presence := snapshot.friends.get(c.legacy_id)) is not None:
+                c.update_status_text(snapshot_status(presence[0]), presence[1])
+                n += 1
+        self.session.log.info("Published %s friends from the snapshot", n)
+
     async def legacy_id_to_jid_username(self, discord_user_id: int) -> str:
         return str(discord_user_id)
 
     async def fill(self):
+        async with self.__fill_lock:
+            await self.__fill()
+
+    async def __fill(self):
+        snapshot = self.session.snapshot
+        if snapshot is not None and not self.session.discord.is_ready():
+            self.__fill_from_snapshot(snapshot)
+            return
+
+        start = time.perf_counter()
+        friends = []
         for relationship in self.session.discord.friends:
             u = relationship.user
             self.session.log.debug("Friend: %r", u)
             if not isinstance(u, di.User):
                 self.session.log.debug("Skipping %s", u)
                 continue
-            c = await self.by_legacy_id(u.id)
-            await c.add_to_roster()
-            c.update_status(relationship.status, relationship.activity)
+            friends.append(relationship)
+
+        batch_size = max(config.ROSTER_FILL_CONCURRENCY, 1)
+
+        # contacts are created one at a time, because slidge's store session
+        # is global and would be shared by concurrent creations
+        contacts = list[Optional[Contact]]()
+        for i, relationship in enumerate(friends):
+            if i and i % batch_size == 0:
+                await asyncio.sleep(0)
+            try:
+                contacts.append(await self.by_legacy_id(relationship.user.id))
+            except XMPPError as e:
+                self.session.log.debug("Skipping %s because of %s", relationship, e)
+                contacts.append(None)
+
+        # but their roster pushes, which wait for the XMPP server, are not
+        semaphore = asyncio.Semaphore(batch_size)
+
+        async def add_to_roster(c: Contact):
+            async with semaphore:
+                await c.add_to_roster()
+
+        await asyncio.gather(*(add_to_roster(c) for c in contacts if c is not None))
+
+        # presences are sent once all contacts are in the roster, in batches
+        # so that we do not hog the event loop for huge rosters
+        for i, (c, relationship) in enumerate(zip(contacts, friends)):
+            if i and i % batch_size == 0:
+                await asyncio.sleep(0)
+            if c is not None:
+                c.update_status(relationship.status, relationship.activity)
+
+        if snapshot is not None:
+            # friends that were removed while we were not connected
+            gone = snapshot.friends.keys() - {r.user.id for r in friends}
+            for c in self:
+                if c.legacy_id in gone:
+                    c.offline()
+
+        self.session.log.info(
+            "Filled the roster with %s friends in %.2f seconds",
+            len(friends),
+            time.perf_counter() - start,
+        )
@@ -1,14 +1,19 @@
+import asyncio
+import re
+import string
 from datetime import datetime
-from typing import Optional, Union
+from typing import Callable, Iterable, NamedTuple, Optional, TypeVar, Union
 
 import discord as di
 import discord.errors
 from slidge import LegacyBookmarks, LegacyMUC, LegacyParticipant, MucType
-from slidge.util.types import Hat
+from slidge.util.types import Hat, Mention
+from slixmpp import JID
 from slixmpp.exceptions import XMPPError
 
 from . import config
 from .contact import Contact
+from .media import AvatarFetcher
 from .session import Session
 from .util import MessageMixin, StatusMixin
 
@@ -16,7 +21,17 @@ from .util import MessageMixin, StatusMixin
 class Bookmarks(LegacyBookmarks[int, "MUC"]):
     session: Session
 
+    def __init__(self, session: Session):
+        super().__init__(session)
+        # fill() runs at login, and again once a warm restart is reconciled
+        # with discord
+        self.__fill_lock = asyncio.Lock()
+
     async def fill(self):
+        async with self.__fill_lock:
+            await self.__fill()
+
+    async def __fill(self):
         for channel in self.session.discord.get_all_channels():
             if isinstance(channel, di.TextChannel):
                 try:
@@ -36,6 +51,343 @@ class Bookmarks(LegacyBookmarks[int, "MUC"]):
 
             await muc.add_to_bookmarks()
 
+    def legacy_id_to_jid(self, legacy_id: int) -> JID:
+        return JID(f"{legacy_id}@{self.xmpp.boundjid.bare}")
+
+    def by_legacy_id_if_exists(self, legacy_id: int) -> Optional["MUC"]:
+        """
+        Get a MUC only if it was resolved before, without calling update_info.
+        """
+        return self.by_jid_only_if_exists(self.legacy_id_to_jid(legacy_id))
+
+
+class IndexedChannel(NamedTuple):
+    name: str
+    jid: JID
+    readable: bool
+
+
+class ChannelIndex:
+    """
+    Index of the text channels of the user's discord servers, to list them
+    without resolving every one of them to a MUC.
+
+    Servers are indexed on first use, then kept up-to-date by channel and
+    role events.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.__guilds = dict[int, dict[int, IndexedChannel]]()
+
+    def __len__(self):
+        return sum(len(channels) for channels in self.__guilds.values())
+
+    def __get(self, guild: di.Guild) -> dict[int, IndexedChannel]:
+        channels = self.__guilds.get(guild.id)
+        if channels is None:
+            channels = self.__guilds[guild.id] = {
+                c.id: self.__index(c) for c in guild.text_channels
+            }
+        return channels
+
+    def channels(self, guild: di.Guild) -> list[IndexedChannel]:
+        return sorted(self.__get(guild).values(), key=lambda c: c.name)
+
+    def readable(self, channel: di.TextChannel) -> bool:
+        indexed = self.__get(channel.guild).get(channel.id)
+        return indexed is not None and indexed.readable
+
+    def update(self, channel: di.abc.GuildChannel):
+        channels = self.__guilds.get(channel.guild.id)
+        if channels is None:
+            return
+        if isinstance(channel, di.TextChannel):
+            channels[channel.id] = self.__index(channel)
+        elif isinstance(channel, di.CategoryChannel):
+            # the names of the channels include their category's, and they may
+            # inherit its permissions
+            for child in channel.text_channels:
+                channels[child.id] = self.__index(child)
+        else:
+            channels.pop(channel.id, None)
+
+    def remove(self, channel: di.abc.GuildChannel):
+        channels = self.__guilds.get(channel.guild.id)
+        if channels is not None:
+            channels.pop(channel.id, None)
+
+    def invalidate(self, guild: di.Guild):
+        self.__guilds.pop(guild.id, None)
+
+    def __index(self, channel: di.TextChannel) -> IndexedChannel:
+        me = channel.guild.me
+        return IndexedChannel(
+            name=channel_name(channel),
+            jid=self.session.bookmarks.legacy_id_to_jid(channel.id),
+            readable=me is not None and channel.permissions_for(me).read_messages,
+        )
+
+
+class ThreadIndex:
+    """
+    Per-guild index of the threads of the user's text channels, including
+    archived ones, for which discord.py's cache returns nothing.
+
+    Kept up-to-date by thread events, with a cached REST fallback for threads
+    that were not seen yet.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.__guilds = dict[int, dict[int, di.Thread]]()
+        # thread ID → ID of its parent text channel, None if not a text channel
+        self.__parents = dict[int, Optional[int]]()
+        self.__unknown = set[int]()
+        self.__fetches = dict[int, asyncio.Task[Optional[di.Thread]]]()
+
+    def __len__(self):
+        return sum(len(threads) for threads in self.__guilds.values())
+
+    def add(self, thread: di.Thread):
+        self.__guilds.setdefault(thread.guild.id, {})[thread.id] = thread
+        self.__unknown.discard(thread.id)
+
+    def remove(self, guild_id: int, thread_id: int):
+        if threads := self.__guilds.get(guild_id):
+            threads.pop(thread_id, None)
+        self.__parents.pop(thread_id, None)
+
+    def forget_channel(self, channel: di.abc.GuildChannel):
+        threads = self.__guilds.get(channel.guild.id, {})
+        for thread_id, thread in list(threads.items()):
+            if thread.parent_id == channel.id:
+                del threads[thread_id]
+                self.__parents.pop(thread_id, None)
+
+    def forget_guild(self, guild_id: int):
+        for thread_id in self.__guilds.pop(guild_id, {}):
+            self.__parents.pop(thread_id, None)
+
+    def parent_id(self, thread: di.Thread) -> Optional[int]:
+        """
+        The ID of the text channel a thread belongs to, or None if it belongs
+        to another type of channel (eg, a forum).
+        """
+        try:
+            return self.__parents[thread.id]
+        except KeyError:
+            pass
+        parent = thread.parent
+        if parent is None:
+            # not in discord.py's cache (yet?)
+            return None
+        parent_id = parent.id if isinstance(parent, di.TextChannel) else None
+        self.__parents[thread.id] = parent_id
+        self.add(thread)
+        return parent_id
+
+    async def get(self, channel: di.TextChannel, thread_id: int) -> Optional[di.Thread]:
+        """
+        Get a thread of a text channel by ID, even if it is archived.
+        """
+        thread = self.__guilds.get(channel.guild.id, {}).get(
+            thread_id
+        ) or channel.get_thread(thread_id)
+        if thread is None:
+            if thread_id in self.__unknown:
+                return None
+            task = self.__fetches.get(thread_id)
+            if task is None:
+                task = self.__fetches[thread_id] = asyncio.create_task(
+                    self.__fetch(thread_id)
+                )
+                task.add_done_callback(lambda _: self.__fetches.pop(thread_id, None))
+            thread = await asyncio.shield(task)
+            if thread is None:
+                return None
+        if thread.parent_id != channel.id:
+            return None
+        self.add(thread)
+        return thread
+
+    async def __fetch(self, thread_id: int) -> Optional[di.Thread]:
+        try:
+            thread = await self.session.discord.fetch_channel(thread_id)
+        except (di.NotFound, di.Forbidden) as e:
+            self.session.log.debug("Could not fetch thread %s: %s", thread_id, e)
+            thread = None
+        if not isinstance(thread, di.Thread):
+            self.__unknown.add(thread_id)
+            return None
+        return thread
+
+
+T = TypeVar("T")
+
+
+class MemberIndex:
+    """
+    Per-guild index of the members' nicknames, as they appear in MUCs, to
+    translate mentions in both directions in a single pass over the text,
+    whatever the size of the guild.
+
+    Guilds are indexed on first use, then kept up-to-date by member events.
+    """
+
+    MENTION = re.compile(r"<(@!?|@&|#)(\d+)>")
+    SEPARATORS = frozenset(string.whitespace + string.punctuation)
+
+    def __init__(self, session: Session):
+        self.session = session
+        # guild ID → member ID → nickname
+        self.__nicks = dict[int, dict[int, str]]()
+        # guild ID → nickname → member IDs
+        self.__ids = dict[int, dict[str, set[int]]]()
+        self.__max_len = dict[int, int]()
+
+    def __len__(self):
+        return sum(len(nicks) for nicks in self.__nicks.values())
+
+    @staticmethod
+    def nick(user: Union[di.User, di.Member]) -> str:
+        # participants are named after their contact, ie, their global
+        # display name, see Contact.update_info
+        return user.global_name or user.name
+
+    def __get(self, guild: di.Guild) -> dict[int, str]:
+        nicks = self.__nicks.get(guild.id)
+        if nicks is None:
+            nicks = self.__nicks[guild.id] = {}
+            self.__ids[guild.id] = {}
+            self.__max_len[guild.id] = 0
+            for m in guild.members:
+                self.add(m)
+        return nicks
+
+    @staticmethod
+    def __participant_nicks(user_id: int, nick: str) -> tuple[str, str]:
+        # slidge appends the contact's JID username, ie, their discord ID, to
+        # the nicknames that are already taken in a MUC
+        return nick, f"{nick} ({user_id})"
+
+    def add(self, member: di.Member):
+        guild_id = member.guild.id
+        nicks = self.__nicks.get(guild_id)
+        if nicks is None:
+            return
+        nick = self.nick(member)
+        if nicks.get(member.id) == nick:
+            return
+        self.remove(guild_id, member.id)
+        nicks[member.id] = nick
+        ids = self.__ids[guild_id]
+        for n in self.__participant_nicks(member.id, nick):
+            ids.setdefault(n, set()).add(member.id)
+            self.__max_len[guild_id] = max(self.__max_len[guild_id], len(n))
+
+    def remove(self, guild_id: int, user_id: int):
+        nicks = self.__nicks.get(guild_id)
+        if nicks is None or (nick := nicks.pop(user_id, None)) is None:
+            return
+        for n in self.__participant_nicks(user_id, nick):
+            ids = self.__ids[guild_id][n]
+            ids.discard(user_id)
+            if not ids:
+                del self.__ids[guild_id][n]
+
+    def update_user(self, user: di.User):
+        for guild_id, nicks in self.__nicks.items():
+            if user.id in nicks and (guild := self.session.discord.get_guild(guild_id)):
+                if (member := guild.get_member(user.id)) is not None:
+                    self.add(member)
+
+    def forget_guild(self, guild_id: int):
+        self.__nicks.pop(guild_id, None)
+        self.__ids.pop(guild_id, None)
+        self.__max_len.pop(guild_id, None)
+
+    def find(
+        self,
+        guild: di.Guild,
+        text: str,
+        resolve: Callable[[str, set[int]], Optional[T]],
+    ) -> list[tuple[int, int, T]]:
+        """
+        Find the nicknames of members in a text, between whitespace or
+        punctuation, longest first.
+
+        :param resolve: Called with a nickname found in the text and the IDs
+            of the members that may have it, returns what the nickname stands
+            for, or None to look for a shorter one.
+        :return: A list of (start, end, resolved nickname)
+        """
+        self.__get(guild)
+        ids = self.__ids[guild.id]
+        max_len = self.__max_len[guild.id]
+        sep = self.SEPARATORS
+        n = len(text)
+        result = list[tuple[int, int, T]]()
+        i = 0
+        while i < n:
+            if i == 0 or text[i - 1] in sep:
+                for j in range(min(n, i + max_len), i, -1):
+                    if (
+                        (j == n or text[j] in sep)
+                        and (found := ids.get(text[i:j]))
+                        and (resolved := resolve(text[i:j], found)) is not None
+                    ):
+                        result.append((i, j, resolved))
+                        i = j
+                        break
+                else:
+                    i += 1
+            else:
+                i += 1
+        return result
+
+    def render(self, message: di.Message, own_nick: Optional[str] = None) -> str:
+        """
+        Replace the user, role and channel mentions of a discord message with
+        names, using the nicknames of the MUC participants for users.
+
+        :param own_nick: The nickname of the user, so that XMPP clients
+            highlight the messages mentioning them
+        """
+        content = message.content
+        if "<" not in content:
+            return content
+        guild = message.guild
+        nicks = self.__get(guild) if guild is not None else {}
+        me = self.session.discord.user
+        mentioned = {u.id: u for u in message.mentions}
+
+        def replace(match: re.Match) -> str:
+            kind, id_ = match.group(1), int(match.group(2))
+            if kind == "#":
+                channel = self.session.discord.get_channel(id_)
+                name = getattr(channel, "name", None)
+                return match.group() if name is None else f"#{name}"
+            if kind == "@&":
+                role = guild.get_role(id_) if guild is not None else None
+                return match.group() if role is None else f"@{role.name}"
+            if me is not None and id_ == me.id and own_nick:
+                return f"@{own_nick}"
+            if (nick := nicks.get(id_)) is not None:
+                return f"@{nick}"
+            if (user := mentioned.get(id_)) is not None:
+                return f"@{self.nick(user)}"
+            return match.group()
+
+        return self.MENTION.sub(replace, content)
+
+
+def channel_name(chan: di.TextChannel) -> str:
+    if chan.category:
+        return f"{chan.guild.name}/{chan.position:02d}/{chan.category}/{chan.name}"
+    else:
+        return f"{chan.guild.name}/{chan.position:02d}/{chan.name}"
+
 
 class Participant(StatusMixin, MessageMixin, LegacyParticipant):
     session: Session
@@ -68,36 +420,99 @@ class MUC(LegacyMUC[int, int, Participant, int]):
 
     async def fill_participants(self):
         chan = await self.get_discord_channel()
-        owner = chan.guild.owner if isinstance(chan, di.TextChannel) else chan.owner
-        for m in await self.members():
+        if self._is_lazy(chan):
+            assert isinstance(chan, di.TextChannel)
+            members = self._lazy_members(chan)
+            self.log.debug("Lazily filling %s with %s members", self, len(members))
+        else:
+            members = await self.members()
+        for m in members:
             p = await self.get_participant_by_legacy_id(m.id)
+            self._update_participant(p, chan, m)
+
+    def _update_participant(
+        self,
+        p: "Participant",
+        chan: Union[di.TextChannel, di.GroupChannel],
+        m: di.Member,
+    ):
+        owner = chan.guild.owner if isinstance(chan, di.TextChannel) else chan.owner
 
-            if isinstance(m, di.Member):
-                p.update_status(m.status, m.activity)
+        if isinstance(m, di.Member):
+            p.update_status(m.status, m.activity)
 
-            p.set_hats(
-                [
-                    Hat(f"urn:slidcord:discord-role:{role.id}", role.name)
-                    for role in m.roles[1:]  # first role is @everyone, useless
-                ]
-            )
+        p.set_hats(
+            [
+                Hat(f"urn:slidcord:discord-role:{role.id}", role.name)
+                for role in m.roles[1:]  # first role is @everyone, useless
+            ]
+        )
 
-            if owner == m:
-                p.role = "moderator"
-                p.affiliation = "owner"
-                continue
+        if owner == m:
+            p.role = "moderator"
+            p.affiliation = "owner"
+            return
 
-            permissions = chan.permissions_for(m)
+        permissions = chan.permissions_for(m)
+        if (
+            permissions.kick_members
+            or permissions.ban_members
+            or permissions.manage_messages
+        ):
+            p.role = "moderator"
+            p.affiliation = "admin"
+        elif not permissions.send_messages:
+            p.role = "visitor"
+            # affiliation="member" is the default
+
+    @staticmethod
+    def _is_lazy(chan: Union[di.TextChannel, di.GroupChannel]) -> bool:
+        if not config.MUC_LAZY_PARTICIPANTS or not isinstance(chan, di.TextChannel):
+            return False
+        n_members = chan.guild.member_count or len(chan.guild.members)
+        return n_members > config.MUC_LAZY_PARTICIPANTS
+
+    def _lazy_members(self, chan: di.TextChannel) -> list[di.Member]:
+        """
+        The owner, moderators, recent speakers and online members (up to
+        MUC_LAZY_PARTICIPANTS) of a large channel. The others are added when
+        they first speak or react.
+
+        Unlike chan.members, this only computes channel permissions for these
+        members, not for the whole guild.
+        """
+        guild = chan.guild
+        mod_roles = {
+            r.id
+            for r in guild.roles
+            if r.permissions.administrator
+            or r.permissions.kick_members
+            or r.permissions.ban_members
+            or r.permissions.manage_messages
+        }
+        speakers = {
+            m.author.id
+            for m in self.session.discord.cached_messages
+            if m.channel.id == chan.id
+        }
+        n_online = 0
+        members = []
+        for m in guild.members:
             if (
-                permissions.kick_members
-                or permissions.ban_members
-                or permissions.manage_messages
+                m.id == guild.owner_id
+                or m.id in speakers
+                or any(r.id in mod_roles for r in m.roles)
+            ):
+                if chan.permissions_for(m).read_messages:
+                    members.append(m)
+            elif (
+                m.status != di.Status.offline
+                and n_online < config.MUC_LAZY_PARTICIPANTS
+                and chan.permissions_for(m).read_messages
             ):
-                p.role = "moderator"
-                p.affiliation = "admin"
-            elif not permissions.send_messages:
-                p.role = "visitor"
-                # affiliation="member" is the default
+                n_online += 1
+                members.append(m)
+        return members
 
     async def members(self):
         chan = await self.get_discord_channel()
@@ -107,6 +522,10 @@ class MUC(LegacyMUC[int, int, Participant, int]):
             return chan.members  # type: ignore
 
     async def user_member(self):
+        chan = await self.get_discord_channel()
+        if isinstance(chan, di.TextChannel):
+            # faster than going through chan.members for large guilds
+            return chan.guild.me
         try:
             me = next(
                 m
@@ -142,33 +561,65 @@ class MUC(LegacyMUC[int, int, Participant, int]):
                 "forbidden", f"You are not allowed to read messages in {self.name}"
             )
 
-        if chan.category:
-            self.name = (
-                f"{chan.guild.name}/{chan.position:02d}/{chan.category}/{chan.name}"
-            )
-        else:
-            self.name = f"{chan.guild.name}/{chan.position:02d}/{chan.name}"
+        self.name = channel_name(chan)
         self.subject = chan.topic
         self.n_participants = chan.guild.approximate_member_count
         if icon := chan.guild.icon:
-            self.avatar = str(icon)
+            self.session.avatars.fetch(self, icon, AvatarFetcher.GROUP)
 
     async def _update_group(self, chan: di.GroupChannel):
-        if chan.name:
-            self.name = chan.name
-        else:
-            recipients = [
-                x
-                for x in chan.recipients
-                if x.id != self.session.discord.user.id  # type:ignore
-            ]
-
-            if len(recipients) == 0:
-                self.name = "Unnamed private group"
-            else:
-                self.name = ", ".join(map(lambda x: x.name, recipients))
+        self.name = self._group_name(chan)
         self.n_participants = len(chan.nicks)
 
+    def _group_name(self, chan: di.GroupChannel) -> str:
+        if chan.name:
+            return chan.name
+        recipients = [
+            x
+            for x in chan.recipients
+            if x.id != self.session.discord.user.id  # type:ignore
+        ]
+        if len(recipients) == 0:
+            return "Unnamed private group"
+        return ", ".join(map(lambda x: x.name, recipients))
+
+    def on_channel_update(
+        self,
+        before: Union[di.TextChannel, di.GroupChannel],
+        after: Union[di.TextChannel, di.GroupChannel],
+    ):
+        """
+        Patch the metadata that changed in a channel update event.
+        """
+        if isinstance(after, di.GroupChannel):
+            assert isinstance(before, di.GroupChannel)
+            self.__patch_name(self._group_name(after))
+            self.n_participants = len(after.nicks)
+            return
+        assert isinstance(before, di.TextChannel)
+        self.__patch_name(channel_name(after))
+        if before.topic != after.topic:
+            self.subject = after.topic  # type:ignore
+
+    def on_guild_update(self, before: di.Guild, after: di.Guild):
+        """
+        Patch the metadata that changed in a guild update event.
+        """
+        chan = after.get_channel(self.legacy_id)
+        if isinstance(chan, di.TextChannel) and before.name != after.name:
+            self.__patch_name(channel_name(chan))
+        if after.icon is not None and after.icon != before.icon:
+            self.session.avatars.fetch(self, after.icon, AvatarFetcher.GROUP)
+        if after.approximate_member_count is not None:
+            self.n_participants = after.approximate_member_count
+
+    def __patch_name(self, name: str):
+        if name == self.name:
+            return
+        self.name = name
+        # the name setter does not persist it
+        self.xmpp.store.rooms.update(self)
+
     async def backfill(self, oldest_id=None, oldest_date=None):
         try:
             await self.history(oldest_date)
@@ -185,32 +636,41 @@ class MUC(LegacyMUC[int, int, Participant, int]):
             msg async for msg in chan.history(limit=config.MUC_BACK_FILL, before=oldest)
         ]
         self.log.debug("Fetched %s messages for %r", len(messages), self.name)
+        if isinstance(chan, di.TextChannel):
+            await self.session.quotes.prefetch(chan, messages)
         for i, msg in enumerate(reversed(messages)):
             self.log.debug("Message %s", i)
             author = msg.author
             if author.id == self.session.discord.user.id:  # type:ignore
                 p = await self.get_user_participant()
             else:
-                try:
-                    p = await self.get_participant_by_contact(
-                        await self.session.contacts.by_discord_user(author)
-                    )
-                except XMPPError:
-                    # deleted users
-                    p = await self.get_participant(author.name)
+                p = await self.get_participant_by_discord_user(author)
             await p.send_message(msg, archive_only=True)
 
-    async def get_participant_by_discord_user(self, user: Union[di.User, di.Member]):
+    async def get_participant_by_discord_user(
+        self, user: Union[di.User, di.Member, di.ClientUser]
+    ):
         if user.discriminator == "0000":
             # a webhook, eg Github#0000
-            # FIXME: avatars for contact-less participants
-            p = await self.get_participant(user.display_name)
-            p.DISCO_CATEGORY = "bot"
-            return p
+            return await self.get_webhook(user.display_name)
         elif user.system:
             return self.get_system_participant()
+        senders = self.session.discord.senders
+        if senders.is_unknown(user.id):
+            return await self.get_participant(user.display_name)
+        lazy_chan = None
+        if user.id != self.session.contacts.user_legacy_id and self._is_lazy(
+            chan := await self.get_discord_channel()
+        ):
+            if p := self.get_participant_by_legacy_id_if_exists(user.id):
+                return p
+            assert isinstance(chan, di.TextChannel)
+            if not isinstance(user, di.Member):
+                # eg, the authors of messages fetched from the history
+                user = chan.guild.get_member(user.id) or user
+            lazy_chan = chan
         try:
-            return await self.get_participant_by_legacy_id(user.id)
+            p = await self.get_participant_by_legacy_id(user.id)
         except XMPPError as e:
             self.log.warning(
                 (
@@ -220,7 +680,79 @@ class MUC(LegacyMUC[int, int, Participant, int]):
                 user,
                 exc_info=e,
             )
+            senders.add_unknown(user.id)
             return await self.get_participant(user.display_name)
+        if lazy_chan is not None and isinstance(user, di.Member):
+            # not added by fill_participants()
+            self._update_participant(p, lazy_chan, user)
+        return p
+
+    def get_participant_by_legacy_id_if_exists(
+        self, user_id: int
+    ) -> Optional[Participant]:
+        """
+        Get a participant only if they were added to this MUC before, without
+        creating a contact for them.
+        """
+        contact = self.session.contacts.by_legacy_id_if_exists(user_id)
+        if contact is None:
+            return None
+        assert self.pk is not None
+        assert contact.contact_pk is not None
+        store = self.xmpp.store
+        with store.session():
+            stored = store.participants.get_by_contact(self.pk, contact.contact_pk)
+            if stored is None:
+                return None
+            return self.Participant.from_store(
+                self.session, stored, muc=self, contact=contact
+            )
+
+    async def get_webhook(self, name: str) -> Participant:
+        # FIXME: avatars for contact-less participants
+        assert self.pk is not None
+        store = self.xmpp.store
+        p: Optional[Participant] = None
+        with store.session():
+            stored = store.participants.get_by_nickname(self.pk, name)
+            if stored is not None:
+                # unlike get_participant(), does not rebuild this MUC from the
+                # store along with the participant
+                p = self.Participant.from_store(self.session, stored, muc=self)
+        if p is None:
+            p = await self.get_participant(name)
+        # not stored by slidge, so set on every instance
+        p.DISCO_CATEGORY = "bot"
+        return p
+
+    async def parse_mentions(self, text: str) -> list[Mention]:
+        chan = await self.get_discord_channel()
+        if not isinstance(chan, di.TextChannel):
+            # group DMs are small, slidge's own parsing is fine
+            return await super().parse_mentions(text)
+
+        def resolve(nick: str, user_ids: set[int]) -> Optional[Contact]:
+            # only the participants of this MUC, by the nickname they have in it
+            for user_id in sorted(user_ids):
+                p = self.get_participant_by_legacy_id_if_exists(user_id)
+                if p is not None and p.nickname == nick and p.contact is not None:
+                    return p.contact
+            return None
+
+        return [
+            Mention(contact, start, end)
+            for start, end, contact in self.session.members.find(
+                chan.guild, text, resolve
+            )
+        ]
+
+    async def moderate_many(self, message_ids: Iterable[int]):
+        system = self.get_system_participant()
+        batch_size = max(config.MODERATION_BATCH_SIZE, 1)
+        for i, message_id in enumerate(sorted(message_ids)):
+            if i and i % batch_size == 0:
+                await asyncio.sleep(config.MODERATION_BATCH_INTERVAL)
+            system.moderate(message_id)
 
     async def create_thread(self, xmpp_id: str) -> int:
         ch = await self.get_discord_channel()
@@ -232,8 +764,9 @@ class MUC(LegacyMUC[int, int, Participant, int]):
         except ValueError:
             pass
         else:
-            if thread_id in (t.id for t in ch.threads):
+            if await self.session.threads.get(ch, thread_id) is not None:
                 return thread_id
 
         thread = await ch.create_thread(name=xmpp_id, type=di.ChannelType.public_thread)
+        self.session.threads.add(thread)
         return thread.id
@@ -0,0 +1,193 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Union
+
+import discord as di
+from slidge import global_config
+
+from . import config
+
+if TYPE_CHECKING:
+    from .contact import Contact
+    from .group import MUC
+    from .session import Session
+
+
+class AttachmentCache:
+    """
+    On-disk cache for discord attachments, shared by all sessions.
+
+    Files are keyed by attachment ID and size, and the least recently used
+    ones are evicted when the cache grows over ``ATTACHMENT_CACHE_SIZE``.
+    Concurrent requests for the same attachment share a single download.
+    """
+
+    def __init__(self):
+        self.__root: Optional[Path] = None
+        # key → size in bytes, least recently used first
+        self.__index = OrderedDict[str, int]()
+        self.__total = 0
+        self.__downloads = dict[str, asyncio.Task[Optional[Path]]]()
+
+    @property
+    def max_size(self) -> int:
+        return config.ATTACHMENT_CACHE_SIZE * 1024 * 1024
+
+    @staticmethod
+    def key(attachment: di.Attachment) -> str:
+        return f"{attachment.id}-{attachment.size}"
+
+    def __load(self) -> Path:
+        if self.__root is not None:
+            return self.__root
+
+        root = global_config.HOME_DIR / "slidcord_attachments"
+        root.mkdir(parents=True, exist_ok=True)
+        files = []
+        for f in root.iterdir():
+            if f.name.startswith("."):
+                # interrupted download
+                f.unlink()
+            else:
+                files.append((f.stat(), f.name))
+        for stat, name in sorted(files, key=lambda x: x[0].st_mtime):
+            self.__index[name] = stat.st_size
+            self.__total += stat.st_size
+        self.__root = root
+        self.__evict()
+        return root
+
+    def __evict(self):
+        assert self.__root is not None
+        while self.__total > self.max_size and self.__index:
+            key, size = self.__index.popitem(last=False)
+            self.__total -= size
+            (self.__root / key).unlink(missing_ok=True)
+            log.debug("Evicted %s from the attachment cache", key)
+
+    async def get(self, attachment: di.Attachment) -> Optional[Path]:
+        """
+        Get a local copy of a discord attachment, downloading it if needed.
+
+        :param attachment: The discord attachment
+        :return: The path to the local copy, or None if the attachment could
+            not (or should not) be cached.
+        """
+        if attachment.size > self.max_size:
+            return None
+
+        root = self.__load()
+        key = self.key(attachment)
+        if (path := self.__hit(root, key)) is not None:
+            return path
+
+        task = self.__downloads.get(key)
+        if task is None:
+            task = self.__downloads[key] = asyncio.create_task(
+                self.__download(attachment, root, key)
+            )
+            task.add_done_callback(lambda _: self.__downloads.pop(key, None))
+        return await asyncio.shield(task)
+
+    def peek(self, attachment: di.Attachment) -> Optional[Path]:
+        """
+        Get the local copy of a discord attachment, only if it is cached.
+        """
+        if attachment.size > self.max_size:
+            return None
+        return self.__hit(self.__load(), self.key(attachment))
+
+    def __hit(self, root: Path, key: str) -> Optional[Path]:
+        if key not in self.__index:
+            return None
+        self.__index.move_to_end(key)
+        path = root / key
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.__total -= self.__index.pop(key)
+            return None
+        return path
+
+    async def __download(
+        self, attachment: di.Attachment, root: Path, key: str
+    ) -> Optional[Path]:
+        tmp = root / f".{key}"
+        try:
+            size = await attachment.save(tmp)
+        except (di.HTTPException, OSError) as e:
+            log.debug("Could not download %s: %r", attachment, e)
+            tmp.unlink(missing_ok=True)
+            return None
+
+        path = root / key
+        tmp.rename(path)
+        self.__index[key] = size
+        self.__total += size
+        self.__evict()
+        return path if key in self.__index else None
+
+
+class AvatarFetcher:
+    """
+    Background avatar pipeline of a session.
+
+    Avatars whose key did not change since slidge last stored them are skipped,
+    downloads are limited to ``AVATAR_FETCH_CONCURRENCY`` at a time, and roster
+    contacts are served before other contacts and groups.
+    """
+
+    FRIEND = 0
+    CONTACT = 1
+    GROUP = 2
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.__queue = asyncio.PriorityQueue[tuple[int, int, str]]()
+        self.__counter = itertools.count()
+        # bare JID → (priority, entity, asset), only the latest request is kept
+        self.__pending = dict[str, tuple[int, Union["Contact", "MUC"], di.Asset]]()
+        self.__n_workers = 0
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def fetch(self, entity: Union["Contact", "MUC"], asset: di.Asset, priority: int):
+        if entity.avatar_id == asset.key:
+            return
+        jid = entity.jid.bare
+        previous = self.__pending.get(jid)
+        if previous is None or priority < previous[0]:
+            self.__queue.put_nowait((priority, next(self.__counter), jid))
+        else:
+            priority = previous[0]
+        self.__pending[jid] = (priority, entity, asset)
+        while self.__n_workers < max(config.AVATAR_FETCH_CONCURRENCY, 1):
+            self.__n_workers += 1
+            self.session.create_task(self.__work())
+
+    async def __work(self):
+        try:
+            while not self.__queue.empty():
+                _, _, jid = self.__queue.get_nowait()
+                try:
+                    _, entity, asset = self.__pending.pop(jid)
+                except KeyError:
+                    # superseded by a higher priority request
+                    continue
+                try:
+                    await entity.set_avatar(asset.url, asset.key, blocking=True)
+                except Exception as e:
+                    self.session.log.warning(
+                        "Could not set the avatar of %s", entity, exc_info=e
+                    )
+        finally:
+            self.__n_workers -= 1
+
+
+attachment_cache = AttachmentCache()
+log = logging.getLogger(__name__)
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Hashable, Optional
+
+from . import tracing
+from .util import TokenBucket
+
+if TYPE_CHECKING:
+    from .session import Session
+
+
+Operation = Callable[[], Awaitable[Any]]
+
+# discord's per-channel rate limits, as (tokens per second, burst)
+RATE_LIMITS = {
+    "message": (1.0, 5),
+    "reaction": (4.0, 1),
+}
+
+# queue latency above which we warn, in seconds
+SLOW_QUEUE = 10
+
+
+class _PendingOperation:
+    __slots__ = "operation", "bucket", "key", "futures", "queued_at", "trace"
+
+    def __init__(self, operation: Operation, bucket: str, key: Optional[Hashable]):
+        self.operation = operation
+        self.bucket = bucket
+        self.key = key
+        self.futures = list[asyncio.Future]()
+        self.queued_at = time.monotonic()
+        self.trace = tracing.current()
+
+
+class _Batch:
+    """
+    Items gathered in a single queued operation, which is sent once the batch
+    is closed.
+    """
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.items = list[Any]()
+        self.size = 0
+        self.closed = asyncio.Event()
+        self.future: Optional[asyncio.Future] = None
+
+
+class _ChannelQueue:
+    def __init__(
+        self, outbox: "Outbox", channel_id: int, buckets: dict[str, TokenBucket]
+    ):
+        self.outbox = outbox
+        self.channel_id = channel_id
+        self.pending = deque[_PendingOperation]()
+        self.by_key = dict[Hashable, _PendingOperation]()
+        self.buckets = buckets
+        self.worker: Optional[asyncio.Task] = None
+        # the batch that can still be added to, if any
+        self.batch: Optional[_Batch] = None
+
+    def put(
+        self, operation: Operation, bucket: str, key: Optional[Hashable]
+    ) -> asyncio.Future:
+        # the open batch is queued before this operation, so it must not take
+        # the items that are put after it
+        self.close_batch()
+        return self.__put(operation, bucket, key)
+
+    def put_batched(
+        self,
+        item: Any,
+        size: int,
+        send: Callable[[list], Awaitable[Any]],
+        key: Hashable,
+        window: float,
+        max_items: int,
+        max_size: int,
+    ) -> tuple[asyncio.Future, bool]:
+        batch = self.batch
+        if batch is not None and (
+            batch.key != key or batch.items and batch.size + size > max_size
+        ):
+            self.close_batch()
+            batch = None
+        first = batch is None
+        if batch is None:
+            batch = self.batch = _Batch(key)
+            batch.future = self.__put(
+                self.__batch_operation(batch, send, window), "message", None
+            )
+        batch.items.append(item)
+        batch.size += size
+        if len(batch.items) >= max_items:
+            self.close_batch()
+        assert batch.future is not None
+        return batch.future, first
+
+    def close_batch(self):
+        if self.batch is not None:
+            self.batch.closed.set()
+            self.batch = None
+
+    def __batch_operation(
+        self, batch: _Batch, send: Callable[[list], Awaitable[Any]], window: float
+    ) -> Operation:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + window
+
+        async def operation():
+            try:
+                await asyncio.wait_for(batch.closed.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                pass
+            if self.batch is batch:
+                self.close_batch()
+            return await send(batch.items)
+
+        return operation
+
+    def __put(
+        self, operation: Operation, bucket: str, key: Optional[Hashable]
+    ) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if key is not None and (pending := self.by_key.get(key)) is not None:
+            # not started yet, the newest operation supersedes it
+            pending.operation = operation
+            pending.trace = tracing.current() or pending.trace
+        else:
+            pending = _PendingOperation(operation, bucket, key)
+            self.pending.append(pending)
+            if key is not None:
+                self.by_key[key] = pending
+        pending.futures.append(future)
+        if self.worker is None:
+            self.worker = self.outbox.session.create_task(self.__work())
+        return future
+
+    async def __work(self):
+        log = self.outbox.session.log
+        try:
+            while self.pending:
+                pending = self.pending[0]
+                await self.buckets[pending.bucket].acquire()
+                self.pending.popleft()
+                if pending.key is not None:
+                    del self.by_key[pending.key]
+
+                now = time.monotonic()
+                latency = now - pending.queued_at
+                log.log(
+                    logging.WARNING if latency > SLOW_QUEUE else logging.DEBUG,
+                    "Sending to discord channel %s after %.2fs in queue",
+                    self.channel_id,
+                    latency,
+                )
+                if pending.trace is not None:
+                    pending.trace.record(
+                        "outbox queue", pending.queued_at, now, bucket=pending.bucket
+                    )
+                try:
+                    with tracing.resume(pending.trace):
+                        result = await pending.operation()
+                except Exception as e:
+                    for f in pending.futures:
+                        if not f.done():
+                            f.set_exception(e)
+                else:
+                    for f in pending.futures:
+                        if not f.done():
+                            f.set_result(result)
+        except asyncio.CancelledError:
+            for pending in self.pending:
+                for f in pending.futures:
+                    f.cancel()
+            self.pending.clear()
+            self.by_key.clear()
+            raise
+        finally:
+            self.worker = None
+            if not self.pending:
+                self.outbox.forget(self)
+
+
+class Outbox:
+    """
+    Per-channel queues of the operations sent to discord.
+
+    Operations are paced ahead of time according to discord's rate limits for
+    the relevant route, instead of running into 429s. Queued operations that
+    are superseded by newer ones (eg, several reactions to the same message)
+    are merged.
+    """
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.__channels = dict[int, _ChannelQueue]()
+        # outlive the queues, so that operations that do not overlap in time
+        # are paced too; dropped once they have refilled
+        self.__buckets = dict[int, dict[str, TokenBucket]]()
+
+    def __len__(self):
+        """
+        Number of queued operations.
+        """
+        return sum(len(q.pending) for q in self.__channels.values())
+
+    def __queue(self, channel_id: int) -> _ChannelQueue:
+        queue = self.__channels.get(channel_id)
+        if queue is None:
+            buckets = self.__buckets.get(channel_id)
+            if buckets is None:
+                buckets = self.__buckets[channel_id] = {
+                    k: TokenBucket(*v) for k, v in RATE_LIMITS.items()
+                }
+            queue = self.__channels[channel_id] = _ChannelQueue(
+                self, channel_id, buckets
+            )
+        return queue
+
+    async def put(
+        self,
+        channel_id: int,
+        operation: Operation,
+        bucket="message",
+        key: Optional[Hashable] = None,
+    ):
+        """
+        Queue an operation and wait for its result.
+
+        :param channel_id: The discord channel the operation targets
+        :param operation: A coroutine function making the actual REST call(s)
+        :param bucket: The rate limit bucket of the operation
+        :param key: If another operation with the same key is still queued,
+            it is replaced by this one, and both callers get its result.
+        """
+        return await self.__queue(channel_id).put(operation, bucket, key)
+
+    async def put_batched(
+        self,
+        channel_id: int,
+        item: Any,
+        send: Callable[[list], Awaitable[Any]],
+        key: Hashable,
+        window: float,
+        max_items: int,
+        size: int,
+        max_size: int,
+    ):
+        """
+        Queue an item that can be sent along with other items in a single
+        operation, eg, files in a multi-attachment message.
+
+        The batch takes the place of its first item in the channel's queue.
+        Items with the same key join it for ``window`` seconds, until there
+        are ``max_items`` of them or their total ``size`` would exceed
+        ``max_size``, or until anything else is queued for the channel. Then
+        ``send`` is called with the list of items as its argument.
+
+        :return: The result of ``send`` for the first item of the batch, None
+            for the others.
+        """
+        future, first = self.__queue(channel_id).put_batched(
+            item, size, send, key, window, max_items, max_size
+        )
+        result = await asyncio.shield(future)
+        return result if first else None
+
+    def forget(self, queue: _ChannelQueue):
+        if self.__channels.get(queue.channel_id) is queue:
+            del self.__channels[queue.channel_id]
+        for channel_id, buckets in list(self.__buckets.items()):
+            if channel_id not in self.__channels and all(
+                b.full for b in buckets.values()
+            ):
+                del self.__buckets[channel_id]
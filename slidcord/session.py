@@ -1,21 +1,31 @@
 import asyncio
+import functools
 import io
+from collections import OrderedDict
 from typing import TYPE_CHECKING, NamedTuple, Optional, Union, cast
 
 import aiohttp
 import discord as di
-from emoji import analyze
 from slidge import BaseSession
 from slidge.util.types import Mention, PseudoPresenceShow, ResourceDict
 from slidge.util.util import replace_mentions
 from slixmpp.exceptions import XMPPError
 
+from . import config
+from .snapshot import Snapshot
+from .snapshot import load as load_snapshot
+from .snapshot import save as save_snapshot
+from .tracing import span
+from .util import first_emoji
+
 if TYPE_CHECKING:
     from .contact import Contact, Roster
-    from .group import MUC
+    from .group import MUC, Bookmarks
 
 Recipient = Union["MUC", "Contact"]
-DiscordRecipient = Union[di.DMChannel, di.TextChannel, di.Thread, di.GroupChannel]
+DiscordRecipient = Union[
+    di.DMChannel, di.TextChannel, di.Thread, di.GroupChannel, di.PartialMessageable
+]
 
 
 class DiscordPresence(NamedTuple):
@@ -25,14 +35,36 @@ class DiscordPresence(NamedTuple):
 
 class Session(BaseSession[int, Recipient]):
     contacts: "Roster"
+    bookmarks: "Bookmarks"
 
     def __init__(self, user):
         super().__init__(user)
         from .client import Discord
+        from .contact import DMChannels, ProfileFetcher
+        from .group import ChannelIndex, MemberIndex, ThreadIndex
+        from .media import AvatarFetcher
+        from .outbox import Outbox
+        from .tracing import Tracer
+        from .util import OwnReactions, QuotedMessages
 
         self.discord = Discord(self)
+        self.outbox = Outbox(self)
+        self.avatars = AvatarFetcher(self)
+        self.profiles = ProfileFetcher(self)
+        self.dms = DMChannels(self)
+        self.channels = ChannelIndex(self)
+        self.threads = ThreadIndex(self)
+        self.members = MemberIndex(self)
+        self.quotes = QuotedMessages()
+        self.reactions = OwnReactions()
+        self.tracer = Tracer(self)
         self.send_lock = asyncio.Lock()
+        # set while the roster is published from a snapshot, see login()
+        self.snapshot: Optional[Snapshot] = None
+        self.__reconciling: Optional[asyncio.Task] = None
         self.__discord_presence: Optional[DiscordPresence] = None
+        # IDs of the discord messages holding several files sent from XMPP
+        self.__albums = OrderedDict[int, None]()
 
     @staticmethod
     def xmpp_to_legacy_msg_id(i: str):
@@ -44,11 +76,56 @@ class Session(BaseSession[int, Recipient]):
         await self.discord.login(token)
         self.xmpp.loop.create_task(self.discord.connect())
 
+        if config.WARM_RESTART and (snapshot := load_snapshot(self)) is not None:
+            # the roster is published from the snapshot by Roster.fill, and
+            # reconciled with discord once the connection is ready
+            self.snapshot = snapshot
+            self.contacts.user_legacy_id = snapshot.user_id
+            self.bookmarks.user_nick = snapshot.user_nick
+            if self.__reconciling is None or self.__reconciling.done():
+                self.__reconciling = self.create_task(self.__reconcile())
+            return f"Logged on as {snapshot.user_name}"
+
+        await self.__wait_until_ready()
+        return f"Logged on as {self.discord.user}"
+
+    async def __wait_until_ready(self):
         await self.discord.wait_until_ready()
         assert self.discord.user is not None
         self.contacts.user_legacy_id = self.discord.user.id
         self.bookmarks.user_nick = str(self.discord.user.display_name)
-        return f"Logged on as {self.discord.user}"
+
+    async def __reconcile(self):
+        await self.__wait_until_ready()
+        self.log.debug("Reconciling the roster and groups with discord")
+        await self.contacts.fill()
+        await self.bookmarks.fill()
+        self.snapshot = None
+        save_snapshot(self)
+
+    def memory_usage(self) -> dict[str, int]:
+        """
+        Number of objects held in memory by this session, per cache.
+        """
+        discord = self.discord
+        return {
+            "discord users": len(discord.users),
+            "discord guilds": len(discord.guilds),
+            "discord private channels": len(discord.private_channels),
+            "discord cached messages": len(discord.cached_messages),
+            "message senders": len(discord.senders),
+            "pending message echoes": len(discord.ignore_next_msg_event),
+            "typing users": len(discord.typing),
+            "indexed channels": len(self.channels),
+            "indexed threads": len(self.threads),
+            "indexed members": len(self.members),
+            "DM channels": len(self.dms),
+            "quoted messages": len(self.quotes),
+            "messages with own reactions": len(self.reactions),
+            "bios": len(self.profiles),
+            "queued avatars": len(self.avatars),
+            "queued outgoing operations": len(self.outbox),
+        }
 
     def __send(self, msg: di.Message):
         mid = msg.id
@@ -72,17 +149,33 @@ class Session(BaseSession[int, Recipient]):
         mentions: Optional[list[Mention]] = None,
         **kwargs,
     ):
-        recipient = await get_recipient(chat, thread)
-        reference = self.__get_ref(reply_to_msg_id, recipient)
-
-        async with self.send_lock:
-            msg = await recipient.send(
-                replace_mentions(text, mentions, contact_to_mention),  # type:ignore
-                reference=reference,  # type:ignore
-            )
-        return self.__send(msg)
+        with self.tracer.trace("xmpp text", chat=str(chat.jid)):
+            with span("get recipient"):
+                recipient = await get_recipient(chat, thread)
+            reference = self.__get_ref(reply_to_msg_id, recipient)
+
+            async def send():
+                # the time spent waiting for the lock is the gap before the
+                # nested span
+                with span("send lock"):
+                    async with self.send_lock:
+                        with span("discord send"):
+                            msg = await recipient.send(
+                                replace_mentions(
+                                    text, mentions, contact_to_mention  # type:ignore
+                                ),
+                                reference=reference,  # type:ignore
+                            )
+                return self.__send(msg)
+
+            return await self.outbox.put(recipient.id, send)
 
     async def logout(self):
+        self.tracer.stop()
+        self.discord.typing.clear()
+        self.profiles.save()
+        if config.WARM_RESTART and self.discord.is_ready():
+            save_snapshot(self)
         await self.discord.close()
 
     async def on_file(
@@ -95,17 +188,47 @@ class Session(BaseSession[int, Recipient]):
         reply_to_msg_id=None,
         **kwargs,
     ):
-        recipient = await get_recipient(chat, thread)
-        reference = self.__get_ref(reply_to_msg_id, recipient)
-
-        async with self.send_lock:
-            msg = await recipient.send(
-                reference=reference,  # type:ignore
-                file=di.File(
-                    io.BytesIO(await http_response.read()), filename=url.split("/")[-1]
-                ),
+        with self.tracer.trace("xmpp file", chat=str(chat.jid)):
+            with span("get recipient"):
+                recipient = await get_recipient(chat, thread)
+            reference = self.__get_ref(reply_to_msg_id, recipient)
+            with span("download"):
+                data = await http_response.read()
+            filename = url.split("/")[-1]
+
+            async def send(files: list[tuple[bytes, str]]):
+                with span("send lock"):
+                    async with self.send_lock:
+                        with span("discord send", files=len(files)):
+                            msg = await recipient.send(
+                                reference=reference,  # type:ignore
+                                files=[
+                                    di.File(io.BytesIO(d), filename=f) for d, f in files
+                                ],
+                            )
+                if len(files) > 1:
+                    self.__albums[msg.id] = None
+                    while len(self.__albums) > MAX_ALBUMS:
+                        self.__albums.popitem(last=False)
+                return self.__send(msg)
+
+            if not config.FILE_BATCH_WINDOW:
+                return await self.outbox.put(
+                    recipient.id, lambda: send([(data, filename)])
+                )
+
+            # files sent in a quick succession (eg, an album) end up in a single
+            # discord message, whose ID is only given to the first of them
+            return await self.outbox.put_batched(
+                recipient.id,
+                (data, filename),
+                send,
+                key=("files", reply_to_msg_id),
+                window=config.FILE_BATCH_WINDOW,
+                max_items=MAX_ATTACHMENTS,
+                size=len(data),
+                max_size=MAX_UPLOAD_SIZE,
             )
-        return self.__send(msg)
 
     async def on_composing(self, c: Recipient, thread=None):
         recipient = await get_recipient(c, thread)
@@ -140,36 +263,110 @@ class Session(BaseSession[int, Recipient]):
         thread=None,
         **kwargs,
     ):
+        self.__check_not_album(legacy_msg_id)
         channel = await get_recipient(chat, thread)
-        self.discord.ignore_next_msg_event.add(legacy_msg_id)
-        m = await channel.fetch_message(legacy_msg_id)
-        await m.edit(
-            content=replace_mentions(text, mentions, contact_to_mention)  # type:ignore
+
+        m = self.discord.get_partial_messageable(channel.id).get_partial_message(
+            legacy_msg_id
         )
 
+        async def correct():
+            self.discord.ignore_next_msg_event.add(legacy_msg_id)
+            await m.edit(
+                content=replace_mentions(
+                    text, mentions, contact_to_mention  # type:ignore
+                )
+            )
+
+        # only the last correction of a message matters
+        await self.outbox.put(channel.id, correct, key=("correct", legacy_msg_id))
+
     async def on_react(
         self, c: Recipient, legacy_msg_id: int, emojis: list[str], thread=None
     ):
         channel = await get_recipient(c, thread)
+        reactions = self.reactions.get(legacy_msg_id)
+        if reactions is None:
+            m = await channel.fetch_message(legacy_msg_id)
+            reactions = self.reactions.seed(
+                legacy_msg_id, self.get_my_legacy_reactions(m)
+            )
+        self.reactions.want(legacy_msg_id, emojis)
+        message = self.discord.get_partial_messageable(channel.id).get_partial_message(
+            legacy_msg_id
+        )
 
-        m = await channel.fetch_message(legacy_msg_id)
-
-        legacy_reactions = set(self.get_my_legacy_reactions(m))
-        xmpp_reactions = set(emojis)
+        async def toggle(emoji: str):
+            # what to do is decided when the operation runs, so that queued
+            # operations reflect the last reactions sent from XMPP
+            reactions = self.reactions.get(legacy_msg_id)
+            add = emoji in self.reactions.wanted(legacy_msg_id)
+            if reactions is not None and add == (emoji in reactions):
+                return
+            self.reactions.expect(legacy_msg_id, emoji, add)
+            try:
+                if add:
+                    await message.add_reaction(emoji)
+                else:
+                    await message.remove_reaction(
+                        emoji, self.discord.user  # type:ignore
+                    )
+            except Exception:
+                self.reactions.unexpect(legacy_msg_id, emoji, add)
+                raise
+            self.reactions.update(legacy_msg_id, emoji, add)
+
+        self.log.debug("%s vs %s", reactions, emojis)
+        await asyncio.gather(
+            *(
+                self.outbox.put(
+                    channel.id,
+                    functools.partial(toggle, e),
+                    bucket="reaction",
+                    key=("react", legacy_msg_id, e),
+                )
+                for e in reactions.symmetric_difference(emojis)
+            )
+        )
 
-        self.log.debug("%s vs %s", legacy_reactions, xmpp_reactions)
-        for e in xmpp_reactions - legacy_reactions:
-            await m.add_reaction(e)
-        for e in legacy_reactions - xmpp_reactions:
-            await m.remove_reaction(e, self.discord.user)  # type:ignore
+    def __check_not_album(self, legacy_msg_id: int):
+        if legacy_msg_id in self.__albums:
+            raise XMPPError(
+                "not-allowed",
+                "This file was sent to discord along with other files, in a "
+                "single message, which cannot be changed from XMPP.",
+            )
 
     async def on_retract(self, c: Recipient, legacy_msg_id: int, thread=None):
+        self.__check_not_album(legacy_msg_id)
         channel = await get_recipient(c, thread)
-        self.discord.ignore_next_msg_event.add(legacy_msg_id)
-        m = await channel.fetch_message(legacy_msg_id)
-        await m.delete()
 
-    async def update_reactions(self, message: di.Message):
+        m = self.discord.get_partial_messageable(channel.id).get_partial_message(
+            legacy_msg_id
+        )
+
+        async def retract():
+            self.discord.ignore_next_msg_event.add(legacy_msg_id)
+            await m.delete()
+
+        await self.outbox.put(channel.id, retract, key=("retract", legacy_msg_id))
+
+    async def update_reactions(
+        self,
+        message: di.Message,
+        emoji: Union[str, di.PartialEmoji, di.Emoji],
+        added: bool,
+    ):
+        if isinstance(emoji, str) and not self.reactions.on_event(
+            message.id, emoji, added
+        ):
+            # echo of a reaction sent from XMPP
+            return
+        reactions = self.reactions.get(message.id)
+        if reactions is None:
+            reactions = self.reactions.seed(
+                message.id, self.get_my_legacy_reactions(message)
+            )
         if isinstance(message.channel, di.DMChannel):
             me = await self.contacts.by_discord_user(message.channel.recipient)
         elif isinstance(message.channel, (di.TextChannel, di.GroupChannel)):
@@ -178,7 +375,7 @@ class Session(BaseSession[int, Recipient]):
         else:
             self.log.warning("Cannot update reactions for %s", message)
             return
-        me.react(message.id, self.get_my_legacy_reactions(message), carbon=True)
+        me.react(message.id, reactions, carbon=True)
 
     @staticmethod
     def get_my_legacy_reactions(message: di.Message) -> list[str]:
@@ -203,12 +400,10 @@ class Session(BaseSession[int, Recipient]):
     ):
         if merged_resource:
             merged_status = merged_resource["status"]
-            try:
-                token = next(analyze(merged_status, False, True))
-            except StopIteration:
-                emoji = None
+            if e := first_emoji(merged_status):
+                emoji = di.PartialEmoji(name=e)
             else:
-                emoji = di.PartialEmoji(name=token.chars)
+                emoji = None
             new = DiscordPresence(
                 status=PRESENCE_SHOW_MAP[merged_resource["show"]],
                 activity=di.CustomActivity(name=merged_status, emoji=emoji)
@@ -242,6 +437,13 @@ class Session(BaseSession[int, Recipient]):
         await self.discord.user.edit(avatar=bytes_)
 
 
+# per discord message
+MAX_ATTACHMENTS = 10
+# total size of the files of a discord message, without nitro
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# number of multi-file messages whose IDs are remembered, see Session.on_file
+MAX_ALBUMS = 1000
+
 PRESENCE_SHOW_MAP = {
     "away": di.Status.idle,
     "xa": di.Status.idle,
@@ -254,19 +456,14 @@ async def get_recipient(chat: Recipient, thread: Optional[int]) -> DiscordRecipi
     if chat.is_group:
         chat = cast("MUC", chat)
         channel = await chat.get_discord_channel()
-        if thread and isinstance(chat, di.TextChannel):
-            discord_thread = channel.get_thread(thread)
+        if thread and isinstance(channel, di.TextChannel):
+            discord_thread = await chat.session.threads.get(channel, thread)
             if discord_thread is not None:
                 return discord_thread
         return channel
     else:
         chat = cast("Contact", chat)
-        dm = chat.discord_user.dm_channel
-        if dm is None:
-            raise XMPPError(
-                "recipient-unavailable", "Could not find the associated DM channel"
-            )
-        return dm
+        return await chat.session.dms.get(chat.legacy_id)
 
 
 def contact_to_mention(c: "Contact") -> str:
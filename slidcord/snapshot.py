@@ -0,0 +1,87 @@
+import json
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import discord as di
+from slidge import global_config
+
+from .util import StatusMixin
+
+if TYPE_CHECKING:
+    from .session import Session
+
+
+class Snapshot(NamedTuple):
+    """
+    What a session needs to publish a working roster right after a restart,
+    before the discord connection is ready.
+
+    Contacts and MUCs (names, avatars, friendship) are already persisted by
+    slidge, so this only holds the user's own discord identity and the last
+    known presences of their friends.
+    """
+
+    user_id: int
+    user_name: str
+    user_nick: str
+    # friend ID → (discord status, status text)
+    friends: dict[int, tuple[str, Optional[str]]]
+
+
+def _path(session: "Session") -> Path:
+    return (
+        global_config.HOME_DIR / "slidcord_snapshots" / f"{session.user_jid.bare}.json"
+    )
+
+
+def load(session: "Session") -> Optional[Snapshot]:
+    try:
+        data = json.loads(_path(session).read_text())
+        return Snapshot(
+            user_id=data["user_id"],
+            user_name=data["user_name"],
+            user_nick=data["user_nick"],
+            friends={int(k): (v[0], v[1]) for k, v in data["friends"].items()},
+        )
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        log.warning("Ignoring invalid snapshot of %s: %r", session.user_jid, e)
+        return None
+
+
+def save(session: "Session"):
+    """
+    Write the current state of a session, which must be logged in to discord.
+    """
+    user = session.discord.user
+    if user is None:
+        return
+    friends = {}
+    for relationship in session.discord.friends:
+        friends[relationship.user.id] = (
+            str(relationship.status),
+            StatusMixin.activity_to_text(relationship.activity),
+        )
+    data = {
+        "user_id": user.id,
+        "user_name": str(user),
+        "user_nick": str(user.display_name),
+        "friends": friends,
+    }
+    path = _path(session)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}")
+    tmp.write_text(json.dumps(data, separators=(",", ":")))
+    tmp.rename(path)
+
+
+def status(value: str) -> di.Status:
+    try:
+        return di.Status(value)
+    except ValueError:
+        return di.Status.offline
+
+
+log = logging.getLogger(__name__)
@@ -0,0 +1,139 @@
+import itertools
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, Iterator, Optional
+
+from slidge import global_config
+
+from . import config
+
+if TYPE_CHECKING:
+    from .session import Session
+
+
+class Trace:
+    """
+    A sampled relay of a single event, from discord to XMPP or the other way
+    around. Its spans are written in the chrome trace event format, one row
+    (thread ID) per trace, so they can be opened in perfetto or about:tracing.
+    """
+
+    __slots__ = "tracer", "id"
+
+    def __init__(self, tracer: "Tracer", id_: int):
+        self.tracer = tracer
+        self.id = id_
+
+    def record(self, name: str, start: float, end: float, **args: Any):
+        self.tracer.write(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": int(start * 1_000_000),
+                "dur": int((end - start) * 1_000_000),
+                "pid": os.getpid(),
+                "tid": self.id,
+                "args": args,
+            }
+        )
+
+
+class Tracer:
+    """
+    Per-session tracing, off by default, and switched on at runtime by an
+    admin command.
+    """
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.__ids = itertools.count(1)
+        self.__file: Optional[IO[str]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__file is not None
+
+    @property
+    def path(self) -> Path:
+        return (
+            global_config.HOME_DIR
+            / "slidcord_traces"
+            / f"{self.session.user_jid.bare}.json"
+        )
+
+    def start(self):
+        if self.__file is not None:
+            return
+        path = self.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.__file = path.open("w")
+        # the format allows the closing bracket to be missing, which lets us
+        # append events without rewriting the file
+        self.__file.write("[\n")
+        self.session.log.info("Tracing to %s", path)
+
+    def stop(self):
+        if self.__file is None:
+            return
+        self.__file.close()
+        self.__file = None
+        self.session.log.info("Stopped tracing")
+
+    def write(self, event: dict):
+        if self.__file is None:
+            return
+        self.__file.write(json.dumps(event, separators=(",", ":")) + ",\n")
+
+    @contextmanager
+    def trace(self, name: str, **args: Any) -> Iterator[None]:
+        """
+        Start a trace, if tracing is enabled and this event is sampled.
+        Spans opened in the same context, including in queued outbox
+        operations, are attached to it.
+        """
+        if not self.enabled or random.random() >= config.TRACE_SAMPLE_RATE:
+            yield
+            return
+        with resume(Trace(self, next(self.__ids))):
+            with span(name, **args):
+                yield
+
+
+@contextmanager
+def resume(trace: Optional[Trace]) -> Iterator[None]:
+    """
+    Attach the spans opened in this context to a trace started elsewhere.
+    """
+    token = _current.set(trace)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """
+    Time a stage of the current trace, if any.
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.record(name, start, time.monotonic(), **args)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("slidcord_trace", default=None)
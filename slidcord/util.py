@@ -1,13 +1,21 @@
-from typing import TYPE_CHECKING, Optional, Union
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import TYPE_CHECKING, Iterable, Optional, Union
 
 import discord as di
-import emoji
-from slidge import LegacyParticipant
+from slidge import LegacyParticipant, global_config
 from slidge.core.mixins.message import ContentMessageMixin
 from slidge.core.mixins.presence import PresenceMixin
 from slidge.util import strip_illegal_chars
 from slidge.util.types import LegacyAttachment, MessageReference
 
+from . import config
+from .media import attachment_cache
+from .tracing import span
+
 if TYPE_CHECKING:
     from .group import MUC
     from .session import Session
@@ -25,18 +33,18 @@ class MessageMixin(ContentMessageMixin):
         legacy_reactions = []
         user = self.discord_user
         for r in m.reactions:
+            if (
+                r.is_custom_emoji()
+                or not isinstance(r.emoji, str)
+                or not is_emoji(r.emoji)
+            ):
+                legacy_emoji = "❓"
+            else:
+                legacy_emoji = r.emoji
             try:
                 async for u in r.users():
                     if u.id == user.id:
-                        if (
-                            r.is_custom_emoji()
-                            or not isinstance(r.emoji, str)
-                            or not emoji.is_emoji(r.emoji)
-                        ):
-                            legacy_reactions.append("❓")
-                        else:
-                            assert isinstance(r.emoji, str)
-                            legacy_reactions.append(r.emoji)
+                        legacy_reactions.append(legacy_emoji)
             except di.NotFound:
                 # the message has now been deleted
                 # seems to happen quite a lot. I guess
@@ -46,7 +54,7 @@ class MessageMixin(ContentMessageMixin):
                 return
         self.react(m.id, legacy_reactions)
 
-    async def _reply_to(self, message: di.Message):
+    async def _reply_to(self, message: di.Message, archive_only=False):
         if not (ref := message.reference):
             return
 
@@ -56,21 +64,31 @@ class MessageMixin(ContentMessageMixin):
 
         reply_to = MessageReference(quoted_msg_id)
 
-        try:
-            if message.type == di.MessageType.thread_starter_message:
-                assert isinstance(message.channel, di.Thread)
-                assert isinstance(message.channel.parent, di.TextChannel)
-                quoted_msg = await message.channel.parent.fetch_message(quoted_msg_id)
-            else:
-                quoted_msg = await message.channel.fetch_message(quoted_msg_id)
-        except di.errors.NotFound:
+        if isinstance(ref.resolved, di.Message):
+            # discord sends the quoted message along with the reply, most of
+            # the time
+            quoted_msg: Optional[di.Message] = ref.resolved
+        elif message.type == di.MessageType.thread_starter_message:
+            assert isinstance(message.channel, di.Thread)
+            assert isinstance(message.channel.parent, di.TextChannel)
+            quoted_msg = await self.session.quotes.get(
+                message.channel.parent, quoted_msg_id
+            )
+        elif archive_only:
+            # fetched along with the history, if at all, see MUC.history()
+            quoted_msg = await self.session.quotes.get(
+                message.channel, quoted_msg_id, fetch=False
+            )
+        else:
+            quoted_msg = await self.session.quotes.get(message.channel, quoted_msg_id)
+        if quoted_msg is None:
             reply_to.body = "[quoted message could not be fetched]"
             return reply_to
 
         if (att := quoted_msg.attachments) and (url := att[0].url):
             reply_to.body = att[0].filename + ": " + url
         else:
-            reply_to.body = quoted_msg.clean_content
+            reply_to.body = self.session.members.render(quoted_msg)
         author = quoted_msg.author
         if author == self.session.discord.user:
             reply_to.author = "user"
@@ -87,15 +105,18 @@ class MessageMixin(ContentMessageMixin):
     async def send_message(
         self, message: di.Message, archive_only=False, correction=False
     ):
-        reply_to = await self._reply_to(message)
+        with span("reply to"):
+            reply_to = await self._reply_to(message, archive_only)
 
+        own_nick = self.muc.user_nick if isinstance(self, LegacyParticipant) else None
+        content = self.session.members.render(message, own_nick)
         mtype = message.type
         if mtype == di.MessageType.thread_created:
-            text = f"/me created a thread named '{message.clean_content}'"
+            text = f"/me created a thread named '{content}'"
         elif mtype == di.MessageType.thread_starter_message:
             text = "I started a new thread from this message ↑"
         else:
-            text = message.clean_content
+            text = content
 
         channel = message.channel
         if isinstance(channel, di.Thread):
@@ -107,37 +128,44 @@ class MessageMixin(ContentMessageMixin):
 
         # it seems attachments cannot be edited in discord anyway, only the text
         # of the message
-        attachments = (
-            [Attachment.from_discord(a) for a in message.attachments]
-            if not correction
-            else []
-        )
+        with span("attachments", n=len(message.attachments)):
+            attachments = (
+                await asyncio.gather(
+                    *(
+                        Attachment.from_discord_cached(a, self.session)
+                        for a in message.attachments
+                    )
+                )
+                if not correction
+                else []
+            )
 
-        await self.send_files(
-            attachments,
-            body_first=True,
-            legacy_msg_id=message.id,
-            when=message.created_at,
-            thread=thread,
-            body=text,
-            reply_to=reply_to,
-            archive_only=archive_only,
-            carbon=message.author == self.session.discord.user,
-            correction=correction,
-        )
+        with span("xmpp send"):
+            await self.send_files(
+                attachments,
+                body_first=True,
+                legacy_msg_id=message.id,
+                when=message.created_at,
+                thread=thread,
+                body=text,
+                reply_to=reply_to,
+                archive_only=archive_only,
+                carbon=message.author == self.session.discord.user,
+                correction=correction,
+            )
 
 
 class StatusMixin(PresenceMixin):
     def update_status(
         self,
         status: di.Status,
-        activity: Optional[
-            Union[di.Activity, di.Game, di.CustomActivity, di.Streaming, di.Spotify]
-        ],
+        activity: Optional[Union[di.BaseActivity, di.Spotify]],
     ):
         # TODO: implement timeouts for activities (the Activity object has timestamps
         #       attached to it)
-        msg = self.activity_to_text(activity)
+        self.update_status_text(status, self.activity_to_text(activity))
+
+    def update_status_text(self, status: di.Status, msg: Optional[str]):
         if status == di.Status.online:
             self.online(msg)
         elif status == di.Status.offline:
@@ -152,9 +180,7 @@ class StatusMixin(PresenceMixin):
 
     @staticmethod
     def activity_to_text(
-        activity: Optional[
-            Union[di.Activity, di.Game, di.CustomActivity, di.Streaming, di.Spotify]
-        ],
+        activity: Optional[Union[di.BaseActivity, di.Spotify]],
     ) -> Optional[str]:
         if isinstance(activity, di.Game):
             return strip_illegal_chars(f"Playing {activity.name}")
@@ -204,3 +230,328 @@ class Attachment(LegacyAttachment):
             content_type=di_attachment.content_type,
             legacy_file_id=di_attachment.id,
         )
+
+    @staticmethod
+    async def from_discord_cached(di_attachment: di.Attachment, session: "Session"):
+        if (
+            not config.ATTACHMENT_CACHE_SIZE
+            or global_config.USE_ATTACHMENT_ORIGINAL_URLS
+        ):
+            return Attachment.from_discord(di_attachment)
+
+        # slidge would move or symlink the file out of the cache
+        read = bool(global_config.NO_UPLOAD_PATH) and (
+            global_config.NO_UPLOAD_METHOD not in ("copy", "hardlink")
+        )
+        if not session.xmpp.store.attachments.get_url(str(di_attachment.id)):
+            path = await attachment_cache.get(di_attachment)
+        elif read:
+            # not worth reading the file, slidge most likely reuses its upload
+            path = None
+        else:
+            # slidge reuses its upload if it is still there. Otherwise, it
+            # uploads the local copy, if any, instead of downloading the
+            # attachment again from discord, whose URLs expire.
+            path = attachment_cache.peek(di_attachment)
+        if path is None:
+            return Attachment.from_discord(di_attachment)
+
+        if read:
+            return Attachment(
+                data=await asyncio.to_thread(path.read_bytes),
+                url=di_attachment.url,
+                name=di_attachment.filename,
+                content_type=di_attachment.content_type,
+                legacy_file_id=di_attachment.id,
+            )
+
+        return Attachment(
+            path=path,
+            url=di_attachment.url,
+            name=di_attachment.filename,
+            content_type=di_attachment.content_type,
+            legacy_file_id=di_attachment.id,
+        )
+
+
+class TokenBucket:
+    """
+    Simple token bucket, to stay under discord's rate limits.
+
+    :param rate: Number of tokens added per second, or 0 for no limit
+    :param capacity: Maximum number of tokens, ie, the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+
+    @property
+    def tokens(self) -> float:
+        now = time.monotonic()
+        self.__tokens = min(
+            self.capacity, self.__tokens + (now - self.__last) * self.rate
+        )
+        self.__last = now
+        return self.__tokens
+
+    @property
+    def full(self) -> bool:
+        """
+        Whether the bucket has refilled, ie, is the same as a new one.
+        """
+        return self.rate <= 0 or self.tokens >= self.capacity
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while (tokens := self.tokens) < 1:
+            await asyncio.sleep((1 - tokens) / self.rate)
+        self.__tokens -= 1
+
+
+class QuotedMessages:
+    """
+    Messages quoted by replies, so that they are not fetched one by one.
+
+    Backfilling a channel resolves the messages quoted by a page of history
+    from the page itself, then by fetching the missing ones in batches, with
+    up to ``MAX_FETCHES_PER_PAGE`` requests. Everything fetched this way is
+    remembered for the next, older pages, until it is edited or deleted.
+    """
+
+    MAX_SIZE = 1000
+    # maximum number of requests made for the quoted messages of a page of
+    # history
+    MAX_FETCHES_PER_PAGE = 10
+    # number of messages fetched around a quoted message, discord's maximum
+    BATCH_SIZE = 100
+
+    def __init__(self):
+        # message ID → message, or None if it was deleted
+        self.__messages = OrderedDict[int, Optional[di.Message]]()
+
+    def __len__(self):
+        return len(self.__messages)
+
+    def __contains__(self, message_id: int):
+        return message_id in self.__messages
+
+    def add(self, message_id: int, message: Optional[di.Message]):
+        self.__messages[message_id] = message
+        self.__messages.move_to_end(message_id)
+        while len(self.__messages) > self.MAX_SIZE:
+            self.__messages.popitem(last=False)
+
+    def discard(self, message_id: int):
+        self.__messages.pop(message_id, None)
+
+    async def get(
+        self, channel: "di.abc.Messageable", message_id: int, fetch=True
+    ) -> Optional[di.Message]:
+        """
+        Get a quoted message.
+
+        :param fetch: Whether to fetch it if it is not in the cache
+        :return: The message, or None if it was deleted or not fetched
+        """
+        try:
+            message = self.__messages[message_id]
+        except KeyError:
+            pass
+        else:
+            self.__messages.move_to_end(message_id)
+            return message
+        if not fetch:
+            return None
+        return await self.__fetch(channel, message_id)
+
+    async def __fetch(
+        self, channel: "di.abc.Messageable", message_id: int
+    ) -> Optional[di.Message]:
+        try:
+            message = await channel.fetch_message(message_id)
+        except di.NotFound:
+            message = None
+        self.add(message_id, message)
+        return message
+
+    async def prefetch(self, channel: di.TextChannel, messages: list[di.Message]):
+        """
+        Resolve the messages quoted in a page of a channel's history.
+        """
+        page = {m.id: m for m in messages}
+        missing = set[int]()
+        for m in messages:
+            if (ref := m.reference) is None or (quoted_id := ref.message_id) is None:
+                continue
+            if (quoted := page.get(quoted_id)) is not None:
+                self.add(quoted_id, quoted)
+            elif isinstance(ref.resolved, di.Message):
+                self.add(quoted_id, ref.resolved)
+            elif quoted_id not in self and ref.channel_id == channel.id:
+                missing.add(quoted_id)
+
+        # newest first, they are the most likely to be close to each other
+        remaining = sorted(missing, reverse=True)
+        for _ in range(self.MAX_FETCHES_PER_PAGE):
+            if not remaining:
+                break
+            if len(remaining) == 1:
+                await self.__fetch(channel, remaining.pop())
+                break
+            remaining = await self.__fetch_around(channel, remaining)
+
+    async def __fetch_around(
+        self, channel: di.TextChannel, missing: list[int]
+    ) -> list[int]:
+        """
+        Fetch the messages around the first missing one, in a single request.
+
+        :return: The messages that are still missing
+        """
+        try:
+            fetched = {
+                m.id: m
+                async for m in channel.history(
+                    limit=self.BATCH_SIZE, around=di.Object(missing[0])
+                )
+            }
+        except di.NotFound:
+            fetched = {}
+        # the fetched messages are contiguous, and include the one they are
+        # around if it exists
+        low = min(fetched, default=missing[0])
+        high = max(fetched, default=missing[0])
+        remaining = []
+        for message_id in missing:
+            if low <= message_id <= high or message_id == missing[0]:
+                self.add(message_id, fetched.get(message_id))
+            else:
+                remaining.append(message_id)
+        return remaining
+
+
+class OwnReactions:
+    """
+    The user's own unicode emoji reactions, per message.
+
+    Kept up-to-date from the reactions sent from XMPP and from the gateway
+    events, so that reacting from XMPP does not require fetching the message
+    (except the first time), and so that the echoes of the reactions sent from
+    XMPP are not relayed back.
+    """
+
+    MAX_SIZE = 10_000
+
+    def __init__(self):
+        # message ID → emojis
+        self.__reactions = OrderedDict[int, set[str]]()
+        # message ID → emojis the user wants, according to XMPP
+        self.__wanted = OrderedDict[int, set[str]]()
+        # (message ID, emoji, added) of the reactions sent to discord whose
+        # event was not received yet, as an ordered set
+        self.__expected = OrderedDict[tuple[int, str, bool], None]()
+
+    def __len__(self):
+        return len(self.__reactions)
+
+    @classmethod
+    def __set(cls, d: OrderedDict, key, value):
+        d[key] = value
+        d.move_to_end(key)
+        while len(d) > cls.MAX_SIZE:
+            d.popitem(last=False)
+
+    def get(self, message_id: int) -> Optional[set[str]]:
+        return self.__reactions.get(message_id)
+
+    def seed(self, message_id: int, emojis: Iterable[str]) -> set[str]:
+        reactions = set(emojis)
+        self.__set(self.__reactions, message_id, reactions)
+        return reactions
+
+    def update(self, message_id: int, emoji: str, added: bool):
+        if (reactions := self.__reactions.get(message_id)) is None:
+            return
+        if added:
+            reactions.add(emoji)
+        else:
+            reactions.discard(emoji)
+
+    def want(self, message_id: int, emojis: Iterable[str]):
+        self.__set(self.__wanted, message_id, set(emojis))
+
+    def wanted(self, message_id: int) -> set[str]:
+        return self.__wanted.get(message_id, set())
+
+    def expect(self, message_id: int, emoji: str, added: bool):
+        self.__set(self.__expected, (message_id, emoji, added), None)
+
+    def unexpect(self, message_id: int, emoji: str, added: bool):
+        self.__expected.pop((message_id, emoji, added), None)
+
+    def on_event(self, message_id: int, emoji: str, added: bool) -> bool:
+        """
+        Apply a reaction event of the user.
+
+        :return: Whether the event should be relayed to XMPP, ie, it is not
+            the echo of a reaction sent from XMPP.
+        """
+        self.update(message_id, emoji, added)
+        try:
+            del self.__expected[(message_id, emoji, added)]
+        except KeyError:
+            return True
+        return False
+
+
+@functools.lru_cache(maxsize=1)
+def _emojis() -> frozenset[str]:
+    # emoji is slow to import and not needed on startup
+    from emoji import EMOJI_DATA
+
+    return frozenset(EMOJI_DATA)
+
+
+@functools.lru_cache(maxsize=1)
+def _emojis_by_first_char() -> dict[str, tuple[str, ...]]:
+    table = defaultdict(list)
+    for e in _emojis():
+        table[e[0]].append(e)
+    # longest first, so that sequences (flags, ZWJ…) win over their components
+    return {c: tuple(sorted(es, key=len, reverse=True)) for c, es in table.items()}
+
+
+@functools.lru_cache(maxsize=1024)
+def is_emoji(text: str) -> bool:
+    """
+    Whether this string is exactly one unicode emoji.
+    """
+    return text in _emojis()
+
+
+@functools.lru_cache(maxsize=1024)
+def first_emoji(text: str) -> Optional[str]:
+    """
+    The first unicode emoji found in a string, if any.
+    """
+    table = _emojis_by_first_char()
+    for i, char in enumerate(text):
+        for e in table.get(char, ()):
+            if text.startswith(e, i):
+                return e
+    return None
+
+
+def rss() -> Optional[int]:
+    """
+    Resident set size of this process in bytes, if available (linux only).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
@@ -0,0 +1,224 @@
+"""
+Soak test: runs many simulated sessions for a long time and reports how the
+memory, object and task counts of the process evolve.
+
+The fake discord backend lives in this process. It feeds slidcord's discord
+event handlers with messages, typing notifications and echoes of the messages
+"sent from XMPP", and answers outgoing operations after a random latency.
+Senders are resolved once, then rebuilt from the session's sender cache and
+a fake store, as in the steady state of a real gateway.
+
+Usage: python -m tests.soak --sessions 100 --hours 4
+"""
+
+import argparse
+import asyncio
+import collections
+import gc
+import itertools
+import logging
+import random
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from slidge import global_config
+
+from slidcord.client import Discord, Resolved
+from slidcord.contact import DMChannels, ProfileFetcher
+from slidcord.group import ChannelIndex, MemberIndex, ThreadIndex
+from slidcord.media import AvatarFetcher
+from slidcord.outbox import Outbox
+from slidcord.session import Session
+from slidcord.tracing import Tracer
+from slidcord.util import OwnReactions, QuotedMessages, rss
+
+CHANNELS_PER_SESSION = 20
+USERS_PER_CHANNEL = 50
+
+message_ids = itertools.count(1)
+
+
+class FakeSender:
+    def __init__(self):
+        self.n_messages = 0
+
+    async def send_message(self, message, **_kwargs):
+        self.n_messages += 1
+
+    def composing(self):
+        pass
+
+    def paused(self):
+        pass
+
+
+class FakeMUC:
+    def __init__(self, legacy_id: int):
+        self.legacy_id = legacy_id
+
+    async def get_participant_by_legacy_id(self, _user_id: int):
+        return FakeSender()
+
+
+class FakeBookmarks:
+    """
+    Rebuilds MUCs on every lookup, like slidge's store does.
+    """
+
+    def __init__(self, channel_ids: set[int]):
+        self.channel_ids = channel_ids
+
+    def by_legacy_id_if_exists(self, legacy_id: int):
+        if legacy_id in self.channel_ids:
+            return FakeMUC(legacy_id)
+        return None
+
+
+class SimulatedSession:
+    """
+    Just enough of a session for slidcord's discord event handlers and
+    per-session caches.
+    """
+
+    memory_usage = Session.memory_usage
+
+    def __init__(self, i: int):
+        self.user_jid = SimpleNamespace(bare=f"user{i}@example.com")
+        self.user = SimpleNamespace(legacy_module_data={})
+        self.log = logging.getLogger(f"soak.{i}")
+        self.send_lock = asyncio.Lock()
+        self.tasks = set[asyncio.Task]()
+        self.tracer = Tracer(self)
+        self.discord = Discord(self)
+        self.outbox = Outbox(self)
+        self.avatars = AvatarFetcher(self)
+        self.profiles = ProfileFetcher(self)
+        self.channels = ChannelIndex(self)
+        self.threads = ThreadIndex(self)
+        self.members = MemberIndex(self)
+        self.quotes = QuotedMessages()
+        self.reactions = OwnReactions()
+        self.dms = DMChannels(self)
+
+        self.channel_objects = [
+            SimpleNamespace(id=i * 1_000_000 + c) for c in range(CHANNELS_PER_SESSION)
+        ]
+        self.bookmarks = FakeBookmarks({c.id for c in self.channel_objects})
+        for channel in self.channel_objects:
+            for u in range(USERS_PER_CHANNEL):
+                self.discord.senders.set(channel.id, u, Resolved(channel.id, u))
+
+    def create_task(self, coro) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def legacy_module_data_update(self, data: dict):
+        self.user.legacy_module_data.update(data)
+
+
+class FakeBackend:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+
+    @staticmethod
+    def message(channel, author_id: int, message_id=None):
+        return SimpleNamespace(
+            id=message_id or next(message_ids),
+            channel=channel,
+            author=SimpleNamespace(id=author_id, discriminator="0001"),
+        )
+
+    async def rest_call(self, session: SimulatedSession, channel):
+        await asyncio.sleep(random.uniform(0.05, 0.5))
+        message_id = next(message_ids)
+        session.discord.ignore_next_msg_event.add(message_id)
+        if random.random() >= self.args.echo_loss:
+            session.create_task(self.echo(session, channel, message_id))
+        return message_id
+
+    async def echo(self, session: SimulatedSession, channel, message_id: int):
+        await asyncio.sleep(random.uniform(0.01, 0.2))
+        await session.discord.on_message(self.message(channel, 0, message_id))
+
+    async def event(self, session: SimulatedSession):
+        channel = random.choice(session.channel_objects)
+        user_id = random.randrange(1, USERS_PER_CHANNEL)
+        r = random.random()
+        if r < 0.4:
+            await session.discord.on_typing(
+                channel, SimpleNamespace(id=user_id, discriminator="0001"), None
+            )
+        elif r < 0.8:
+            await session.discord.on_message(self.message(channel, user_id))
+        else:
+            session.create_task(
+                session.outbox.put(channel.id, lambda: self.rest_call(session, channel))
+            )
+
+    async def run(self, sessions: list[SimulatedSession], end: float):
+        delay = 1 / self.args.events_per_second
+        while time.monotonic() < end:
+            await self.event(random.choice(sessions))
+            await asyncio.sleep(delay)
+
+
+def object_counts() -> collections.Counter:
+    return collections.Counter(type(o).__name__ for o in gc.get_objects())
+
+
+def report(start: float, initial: collections.Counter, sessions):
+    gc.collect()
+    counts = object_counts()
+    growth = counts - initial
+    size = rss()
+    usage = collections.Counter()
+    for s in sessions:
+        usage.update(s.memory_usage())
+    print(
+        f"[{(time.monotonic() - start) / 60:7.1f} min] "
+        f"rss={size / 1024 / 1024 if size else float('nan'):.1f}MiB "
+        f"objects={sum(counts.values())} "
+        f"tasks={len(asyncio.all_tasks())}"
+    )
+    print(
+        "  most grown types:", ", ".join(f"{k}+{v}" for k, v in growth.most_common(5))
+    )
+    print("  session caches:", ", ".join(f"{k}={v}" for k, v in usage.items() if v))
+
+
+async def main(args: argparse.Namespace):
+    global_config.HOME_DIR = Path(tempfile.mkdtemp())
+    sessions = [SimulatedSession(i) for i in range(args.sessions)]
+    gc.collect()
+    initial = object_counts()
+    start = time.monotonic()
+    end = start + args.hours * 3600
+    backend = FakeBackend(args)
+    runner = asyncio.create_task(backend.run(sessions, end))
+    while not runner.done():
+        await asyncio.wait([runner], timeout=args.interval)
+        report(start, initial, sessions)
+    for s in sessions:
+        for t in s.tasks:
+            t.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--hours", type=float, default=1)
+    parser.add_argument("--events-per-second", type=float, default=200)
+    parser.add_argument(
+        "--echo-loss",
+        type=float,
+        default=0.01,
+        help="Fraction of the messages sent to discord that are never echoed",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=60, help="Seconds between reports"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+# generous, slidcord's own modules take ~20ms to import on a laptop
+MAX_SELF_IMPORT_TIME_US = 250_000
+
+
+def import_slidcord(*args: str):
+    return subprocess.run(
+        [sys.executable, *args, "-c", "import slidcord, sys; print(*sys.modules)"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_emoji_is_imported_lazily():
+    modules = import_slidcord().stdout.split()
+    assert "emoji" not in modules
+
+
+def test_import_time():
+    # -X importtime lines look like:
+    # import time: self [us] | cumulative | imported package
+    self_time = 0
+    for line in import_slidcord("-X", "importtime").stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        us, _, name = line.removeprefix("import time:").split("|")
+        if name.strip().startswith("slidcord"):
+            self_time += int(us)
+    assert 0 < self_time < MAX_SELF_IMPORT_TIME_US
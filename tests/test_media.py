@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from slidge import global_config
+
+from slidcord import config
+from slidcord.media import AttachmentCache
+
+KIB = 1024
+
+
+class FakeAttachment:
+    def __init__(self, id_: int, size: int):
+        self.id = id_
+        self.size = size
+        self.downloads = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def save(self, path):
+        self.downloads += 1
+        await self.release.wait()
+        path.write_bytes(b"x" * self.size)
+        return self.size
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(global_config, "HOME_DIR", tmp_path, raising=False)
+    monkeypatch.setattr(config, "ATTACHMENT_CACHE_SIZE", 1)
+    return AttachmentCache()
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_are_evicted(cache, tmp_path):
+    a, b, c = (FakeAttachment(i, 400 * KIB) for i in range(3))
+    await cache.get(a)
+    await cache.get(b)
+    await cache.get(a)
+    await cache.get(c)
+
+    files = {f.name for f in (tmp_path / "slidcord_attachments").iterdir()}
+    assert files == {cache.key(a), cache.key(c)}
+    assert (
+        sum(f.stat().st_size for f in (tmp_path / "slidcord_attachments").iterdir())
+        <= 1024 * KIB
+    )
+
+    await cache.get(b)
+    assert b.downloads == 2
+    assert a.downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_too_large_is_not_cached(cache):
+    a = FakeAttachment(1, 2048 * KIB)
+    assert await cache.get(a) is None
+    assert a.downloads == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_a_download(cache):
+    a = FakeAttachment(1, 10 * KIB)
+    a.release.clear()
+    gets = [asyncio.create_task(cache.get(a)) for _ in range(5)]
+    await asyncio.sleep(0)
+    a.release.set()
+    paths = await asyncio.gather(*gets)
+    assert a.downloads == 1
+    assert len(set(paths)) == 1
+    assert paths[0].stat().st_size == 10 * KIB
+
+
+@pytest.mark.asyncio
+async def test_peek_does_not_download(cache):
+    a = FakeAttachment(1, 10 * KIB)
+    assert cache.peek(a) is None
+    assert a.downloads == 0
+    path = await cache.get(a)
+    assert cache.peek(a) == path
+    assert a.downloads == 1
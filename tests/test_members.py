@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+
+from slidcord.group import MemberIndex
+
+ME = 99
+
+
+def make_member(guild, id_: int, name: str, global_name: Optional[str] = None):
+    return SimpleNamespace(id=id_, name=name, global_name=global_name, guild=guild)
+
+
+@pytest.fixture
+def guild():
+    guild = SimpleNamespace(id=1, members=[])
+    guild.members += [
+        make_member(guild, 1, "bob"),
+        make_member(guild, 2, "bob2", "Bob Marley"),
+        make_member(guild, 3, "bobby", "bob"),
+        make_member(guild, ME, "me", "Myself"),
+    ]
+    roles = {10: SimpleNamespace(name="admins")}
+    guild.get_role = roles.get
+    return guild
+
+
+@pytest.fixture
+def index():
+    channels = {20: SimpleNamespace(name="general")}
+    discord = SimpleNamespace(user=SimpleNamespace(id=ME), get_channel=channels.get)
+    return MemberIndex(SimpleNamespace(discord=discord))  # type:ignore
+
+
+def find_all(index, guild, text):
+    return [
+        (text[i:j], ids) for i, j, ids in index.find(guild, text, lambda _n, ids: ids)
+    ]
+
+
+def test_longest_nickname_is_found_first(index, guild):
+    assert find_all(index, guild, "hi Bob Marley!") == [("Bob Marley", {2})]
+
+
+def test_nicknames_are_found_between_separators(index, guild):
+    assert find_all(index, guild, "bobcat bob, (bob) xbob") == [
+        ("bob", {1, 3}),
+        ("bob", {1, 3}),
+    ]
+
+
+def test_shorter_nickname_if_longest_is_not_resolved(index, guild):
+    found = index.find(
+        guild, "Bob Marley", lambda nick, _ids: nick if nick != "Bob Marley" else None
+    )
+    assert found == []
+    found = index.find(guild, "bob Marley", lambda nick, _ids: nick)
+    assert found == [(0, 3, "bob")]
+
+
+def test_nickname_conflict_suffix(index, guild):
+    assert find_all(index, guild, "hey bob (3) and bob (1)") == [
+        ("bob (3)", {3}),
+        ("bob (1)", {1}),
+    ]
+
+
+def test_renamed_members_are_reindexed(index, guild):
+    assert find_all(index, guild, "bob") == [("bob", {1, 3})]
+    index.add(make_member(guild, 3, "bobby", "Robert"))
+    assert find_all(index, guild, "bob Robert bob (3)") == [
+        ("bob", {1}),
+        ("Robert", {3}),
+        # "bob (3)" is not a nickname anymore
+        ("bob", {1}),
+    ]
+    index.remove(guild.id, 1)
+    assert find_all(index, guild, "bob") == []
+
+
+def render(index, guild, content, mentions=(), own_nick=None):
+    message = SimpleNamespace(content=content, guild=guild, mentions=list(mentions))
+    return index.render(message, own_nick)
+
+
+def test_user_mentions_are_rendered_as_nicknames(index, guild):
+    assert render(index, guild, "<@1> <@!2>") == "@bob @Bob Marley"
+
+
+def test_own_mentions_use_own_nick(index, guild):
+    assert render(index, guild, "hi <@99>", own_nick="me in xmpp") == "hi @me in xmpp"
+    assert render(index, guild, "hi <@99>") == "hi @Myself"
+
+
+def test_role_and_channel_mentions(index, guild):
+    assert render(index, guild, "<@&10> see <#20>") == "@admins see #general"
+
+
+def test_unknown_mentions_are_left_as_is(index, guild):
+    text = "<@1234> <@&11> <#21>"
+    assert render(index, guild, text) == text
+
+
+def test_mentioned_non_members_are_rendered(index, guild):
+    stranger = SimpleNamespace(id=1234, name="stranger", global_name=None)
+    assert render(index, guild, "<@1234>", [stranger]) == "@stranger"
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from slidcord import outbox
+from slidcord.outbox import Outbox
+from slidcord.util import TokenBucket
+
+
+def make_outbox() -> Outbox:
+    loop = asyncio.get_running_loop()
+    return Outbox(
+        SimpleNamespace(  # type:ignore
+            log=logging.getLogger(__name__), create_task=loop.create_task
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_operations_run_in_order():
+    box = make_outbox()
+    sent = []
+
+    async def send(i):
+        await asyncio.sleep(0)
+        sent.append(i)
+        return i
+
+    results = await asyncio.gather(*(box.put(1, lambda i=i: send(i)) for i in range(5)))
+    assert sent == results == list(range(5))
+    assert len(box) == 0
+
+
+@pytest.mark.asyncio
+async def test_queued_operation_is_superseded():
+    box = make_outbox()
+    sent = []
+
+    async def send(i):
+        sent.append(i)
+        return i
+
+    first = asyncio.create_task(box.put(1, lambda: send("first")))
+    await asyncio.sleep(0)
+    results = await asyncio.gather(
+        first,
+        box.put(1, lambda: send("old"), key="k"),
+        box.put(1, lambda: send("new"), key="k"),
+    )
+    assert results == ["first", "new", "new"]
+    assert sent == ["first", "new"]
+
+
+@pytest.mark.asyncio
+async def test_operations_are_paced(monkeypatch):
+    monkeypatch.setitem(outbox.RATE_LIMITS, "message", (20.0, 2))
+    box = make_outbox()
+
+    async def send():
+        return time.monotonic()
+
+    start = time.monotonic()
+    times = await asyncio.gather(*(box.put(1, send) for _ in range(4)))
+    assert times[1] - start < 0.04
+    assert times[3] - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_sequential_operations_are_paced(monkeypatch):
+    monkeypatch.setitem(outbox.RATE_LIMITS, "message", (20.0, 2))
+    box = make_outbox()
+
+    async def send():
+        return time.monotonic()
+
+    start = time.monotonic()
+    times = [await box.put(1, send) for _ in range(4)]
+    assert times[1] - start < 0.04
+    assert times[3] - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_refilled_buckets_are_dropped(monkeypatch):
+    monkeypatch.setitem(outbox.RATE_LIMITS, "message", (100.0, 1))
+    box = make_outbox()
+
+    async def send():
+        return time.monotonic()
+
+    await box.put(1, send)
+    assert box._Outbox__buckets  # type:ignore
+    await asyncio.sleep(0.02)
+    await box.put(2, send)
+    assert list(box._Outbox__buckets) == [2]  # type:ignore
+
+
+@pytest.mark.asyncio
+async def test_channels_are_paced_independently(monkeypatch):
+    monkeypatch.setitem(outbox.RATE_LIMITS, "message", (1.0, 1))
+    box = make_outbox()
+
+    async def send():
+        return time.monotonic()
+
+    start = time.monotonic()
+    times = await asyncio.gather(*(box.put(c, send) for c in range(5)))
+    assert max(times) - start < 0.5
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    bucket = TokenBucket(20, 3)
+    start = time.monotonic()
+    for _ in range(5):
+        await bucket.acquire()
+    elapsed = time.monotonic() - start
+    assert 0.09 <= elapsed < 0.5
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_without_rate_is_unlimited():
+    bucket = TokenBucket(0, 1)
+    start = time.monotonic()
+    for _ in range(100):
+        await bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_batch_keeps_its_place_in_the_queue():
+    box = make_outbox()
+    sent = []
+
+    async def send(items):
+        sent.append(items)
+        return len(sent)
+
+    def put_file(name: str):
+        return asyncio.create_task(
+            box.put_batched(
+                1, name, send, key="files", window=1, max_items=10, size=4, max_size=10
+            )
+        )
+
+    files = [put_file("a"), put_file("b"), put_file("c")]
+    await asyncio.sleep(0)
+    text = box.put(1, lambda: send("text"))
+    results = await asyncio.gather(*files, text)
+    # split by size, and closed by the text
+    assert sent == [["a", "b"], ["c"], "text"]
+    assert results == [1, None, 2, 3]
@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import discord as di
+import pytest
+
+from slidcord.util import QuotedMessages
+
+
+class FakeChannel(di.TextChannel):
+    def __init__(self, message_ids: list[int]):
+        self.id = 1
+        self.messages = {i: SimpleNamespace(id=i) for i in message_ids}
+        self.fetches = 0
+        self.histories = 0
+
+    async def fetch_message(self, id: int):
+        self.fetches += 1
+        try:
+            return self.messages[id]
+        except KeyError:
+            raise di.NotFound(SimpleNamespace(status=404, reason=""), "")
+
+    async def history(self, *, limit, around):  # type:ignore
+        self.histories += 1
+        ids = sorted(self.messages)
+        before = [i for i in ids if i < around.id][-(limit // 2) :]
+        after = [i for i in ids if i >= around.id][: limit - len(before)]
+        for i in reversed(before + after):
+            yield self.messages[i]
+
+
+def reply(id_: int, quoted_id: int):
+    return SimpleNamespace(
+        id=id_,
+        reference=SimpleNamespace(message_id=quoted_id, resolved=None, channel_id=1),
+    )
+
+
+@pytest.mark.asyncio
+async def test_quoted_messages_are_fetched_in_batches():
+    # 150 is deleted
+    channel = FakeChannel([i for i in range(1, 301) if i != 150])
+    page = [reply(10_000 + i, quoted) for i, quoted in enumerate((2, 10, 20, 150, 260))]
+    quotes = QuotedMessages()
+    await quotes.prefetch(channel, page)  # type:ignore
+
+    assert channel.fetches == 0
+    assert channel.histories == 3
+    for i in 2, 10, 20, 260:
+        assert (await quotes.get(channel, i, fetch=False)).id == i  # type:ignore
+    assert 150 in quotes
+    assert await quotes.get(channel, 150, fetch=False) is None
+
+
+@pytest.mark.asyncio
+async def test_single_quoted_message_is_fetched_alone():
+    channel = FakeChannel([1, 2, 3])
+    quotes = QuotedMessages()
+    await quotes.prefetch(channel, [reply(10, 2), reply(11, 3)])  # type:ignore
+    await quotes.prefetch(channel, [reply(12, 1)])  # type:ignore
+    assert channel.fetches == 1
+    assert channel.histories == 1
+    assert len(quotes) == 3
+
+
+@pytest.mark.asyncio
+async def test_quoted_message_fetches_are_capped(monkeypatch):
+    monkeypatch.setattr(QuotedMessages, "BATCH_SIZE", 2)
+    channel = FakeChannel(list(range(0, 1000, 10)))
+    quotes = QuotedMessages()
+    page = [reply(10_000 + i, i * 100) for i in range(12)]
+    await quotes.prefetch(channel, page)  # type:ignore
+    assert channel.histories == QuotedMessages.MAX_FETCHES_PER_PAGE
+    assert channel.fetches == 0
+    # the oldest ones
+    assert 0 not in quotes and 100 not in quotes
+    assert len(quotes) == 10